@@ -0,0 +1,239 @@
+"""A mutable tree implementation backed by content addressed blobs."""
+
+
+import collections
+import hashlib
+
+from mimic.__mimic import common
+
+from . import model
+from . import settings
+
+from google.appengine.ext import ndb
+
+
+# kind of the (never stored) tree root entity
+_TREE_KIND = 'Tree'
+
+
+class BlobTree(common.Tree):
+  """An implementation of Tree which stores blob references per path.
+
+  Identical file contents are stored once, no matter how many trees or paths
+  refer to them. Copying files between trees via GetFiles() and PutFiles()
+  only writes references.
+  """
+
+  def __init__(self, namespace, access_key=''):
+    super(BlobTree, self).__init__(namespace, access_key)
+    self.namespace = namespace
+    self.access_key = access_key
+    self._tree_key = ndb.Key(_TREE_KIND, namespace,
+                             namespace=settings.PLAYGROUND_NAMESPACE)
+
+  def __repr__(self):
+    return ('<{0} namespace={1!r}>'
+            .format(self.__class__.__name__, self.namespace))
+
+  def _FileKey(self, path):
+    return ndb.Key(model.TreeFile, path, parent=self._tree_key)
+
+  def _GetTreeFile(self, path):
+    return self._FileKey(path).get()
+
+  def _ListTreeFileKeys(self, path):
+    path = self._NormalizeDirectoryPath(path) or ''
+    query = model.TreeFile.query(ancestor=self._tree_key)
+    if path:
+      # normalized directory paths end in '/', which '0' immediately follows
+      successor = path[:-1] + '0'
+      query = query.filter(model.TreeFile.key >= self._FileKey(path),
+                           model.TreeFile.key < self._FileKey(successor))
+    return query.fetch(keys_only=True)
+
+  @ndb.transactional(xg=True)
+  def _UpdateTreeFilesInTransaction(self, updates, contents):
+    paths = list(updates)
+    keys = [self._FileKey(path) for path in paths]
+    deltas = collections.defaultdict(int)
+    to_put = []
+    to_delete = []
+    for path, key, f in zip(paths, keys, ndb.get_multi(keys)):
+      if f:
+        deltas[f.blob] -= 1
+      if updates[path]:
+        blob, size = updates[path]
+        deltas[blob] += 1
+        to_put.append(model.TreeFile(key=key, blob=blob, size=size))
+      elif f:
+        to_delete.append(key)
+    ndb.put_multi(to_put)
+    ndb.delete_multi(to_delete)
+    model.ApplyBlobReferences(deltas, contents)
+
+  def _UpdateTreeFiles(self, updates, contents=None):
+    """Update paths and the blob references they hold.
+
+    Each batch of paths is updated in a single transaction along with the
+    reference counts of the blobs they point to, so that concurrent writers
+    cannot leak or double count references.
+
+    Args:
+      updates: A dict mapping paths to a (blob, size) tuple, or to None to
+          delete the path.
+      contents: A dict of blob id to content, for blobs which may not exist yet.
+    """
+    contents = contents or {}
+    batch = {}
+    batch_bytes = 0
+    for path in sorted(updates):
+      update = updates[path]
+      size = update[1] if update and update[0] in contents else 0
+      if batch and (len(batch) >= settings.TREE_FILE_TRANSACTION_SIZE or
+                    batch_bytes + size > settings.BLOB_TRANSACTION_BYTES):
+        self._UpdateTreeFilesInTransaction(batch, contents)
+        batch = {}
+        batch_bytes = 0
+      batch[path] = update
+      batch_bytes += size
+    if batch:
+      self._UpdateTreeFilesInTransaction(batch, contents)
+
+  def IsMutable(self):
+    return True
+
+  def GetFileContents(self, path):
+    f = self._GetTreeFile(path)
+    if not f:
+      return None
+    return model.GetBlobContents(f.blob, f.size)
+
+  def GetFileSize(self, path):
+    f = self._GetTreeFile(path)
+    if not f:
+      return None
+    return f.size
+
+  def GetFileLastModified(self, path):
+    f = self._GetTreeFile(path)
+    if not f:
+      return None
+    return f.updated
+
+  def HasFile(self, path):
+    # root always exists, even if there are no files in the tree
+    if path == '':  # pylint: disable-msg=C6403
+      return True
+    return self._GetTreeFile(path) is not None
+
+  def MoveFile(self, path, newpath):
+    """Rename a file.
+
+    Args:
+      path: The file path to rename.
+      newpath: The new path.
+
+    Returns:
+      True if the move succeeded.
+    """
+    if path == newpath:
+      return self.HasFile(path)
+    return self._MoveFileInTransaction(path, newpath)
+
+  @ndb.transactional(xg=True)
+  def _MoveFileInTransaction(self, path, newpath):
+    f, replaced = ndb.get_multi([self._FileKey(path), self._FileKey(newpath)])
+    if not f:
+      return False
+    model.TreeFile(key=self._FileKey(newpath), blob=f.blob, size=f.size).put()
+    f.key.delete()
+    if replaced:
+      model.ApplyBlobReferences({replaced.blob: -1}, {})
+    return True
+
+  def DeletePath(self, path):
+    """Delete a file or directory.
+
+    Args:
+      path: The path to delete.
+
+    Returns:
+      True if the delete succeeded.
+    """
+    paths = [key.id() for key in self._ListTreeFileKeys(path)]
+    if path:
+      paths.append(path)
+    self._UpdateTreeFiles(dict((p, None) for p in paths))
+    return True
+
+  def Clear(self):
+    self.DeletePath('')
+
+  def SetFile(self, path, contents):
+    self.SetFiles({path: contents})
+
+  def SetFiles(self, files):
+    """Write many files with batched datastore calls.
+
+    Args:
+      files: A dict mapping file paths to contents.
+    """
+    updates = {}
+    contents = {}
+    for path, content in files.iteritems():
+      blob = hashlib.sha1(content).hexdigest()
+      updates[path] = (blob, len(content))
+      contents[blob] = content
+    self._UpdateTreeFiles(updates, contents)
+
+  def GetFiles(self, path):
+    """Get the blob references of all files in a directory or the tree.
+
+    Args:
+      path: The directory path or None for the entire tree.
+
+    Returns:
+      A list of TreeFile entities, to be passed to PutFiles().
+    """
+    return [f for f in ndb.get_multi(self._ListTreeFileKeys(path)) if f]
+
+  def PutFiles(self, files):
+    """Write blob references obtained from GetFiles() on any BlobTree.
+
+    Args:
+      files: A list of TreeFile entities.
+    """
+    self._UpdateTreeFiles(dict((f.key.id(), (f.blob, f.size))
+                               for f in files))
+
+  def GetFileStats(self, paths):
+    """Get file metadata without reading file contents.
+
+    Args:
+      paths: A list of file paths or None for the entire tree.
+
+    Returns:
+      A dict mapping each existing path to a dict with 'size', 'mtime' and
+      'hash' (the SHA-1 hex digest of the contents).
+    """
+    if paths is None:
+      keys = self._ListTreeFileKeys(None)
+    else:
+      keys = [self._FileKey(path) for path in paths]
+    return dict((f.key.id(), {'size': f.size, 'mtime': f.updated,
+                              'hash': f.blob})
+                for f in ndb.get_multi(keys) if f)
+
+  def HasDirectory(self, path):
+    return bool(self._ListTreeFileKeys(path))
+
+  def ListDirectory(self, path):
+    """List the current directory or tree contents.
+
+    Args:
+      path: The directory path to list or None to access the entire tree.
+
+    Returns:
+      A sorted list of file paths in the specified directory or tree.
+    """
+    return sorted([key.id() for key in self._ListTreeFileKeys(path)])
@@ -0,0 +1,124 @@
+"""Tests for blob_tree.py."""
+
+import hashlib
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from . import blob_tree
+from . import model
+from . import settings
+
+
+def _Sha(content):
+  return hashlib.sha1(content).hexdigest()
+
+
+class BlobTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # cross-group transactions require the high replication datastore
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.tree = blob_tree.BlobTree('a')
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def _RefCount(self, content):
+    blob = model._BlobKey(_Sha(content)).get()
+    return blob.refcount if blob else 0
+
+  def _NumBlobs(self):
+    return model.Blob.query(namespace=settings.PLAYGROUND_NAMESPACE).count()
+
+  def _NumChunks(self, content):
+    blob_key = model._BlobKey(_Sha(content))
+    return model.BlobChunk.query(ancestor=blob_key).count()
+
+  def testSetFile(self):
+    self.tree.SetFile('app.yaml', 'app')
+    self.assertEqual('app', self.tree.GetFileContents('app.yaml'))
+    self.assertEqual(3, self.tree.GetFileSize('app.yaml'))
+    self.assertEqual(1, self._RefCount('app'))
+    self.assertEqual(1, self._NumChunks('app'))
+
+  def testIdenticalContentIsShared(self):
+    self.tree.SetFiles({'a.txt': 'same', 'b.txt': 'same', 'c.txt': 'other'})
+    self.assertEqual(2, self._RefCount('same'))
+    self.assertEqual(1, self._RefCount('other'))
+    self.assertEqual(2, self._NumBlobs())
+
+  def testOverwriteReleasesOldBlob(self):
+    self.tree.SetFile('main.py', 'old')
+    self.tree.SetFile('main.py', 'new')
+    self.assertEqual('new', self.tree.GetFileContents('main.py'))
+    self.assertEqual(0, self._RefCount('old'))
+    self.assertEqual(0, self._NumChunks('old'))
+    self.assertEqual(1, self._RefCount('new'))
+
+  def testRewriteSameContent(self):
+    self.tree.SetFile('main.py', 'same')
+    self.tree.SetFile('main.py', 'same')
+    self.assertEqual(1, self._RefCount('same'))
+
+  def testPutFilesBetweenTrees(self):
+    self.tree.SetFiles({'app.yaml': 'app', 'static/a.css': 'css'})
+    other = blob_tree.BlobTree('b')
+    other.PutFiles(self.tree.GetFiles(None))
+    self.assertEqual(['app.yaml', 'static/a.css'], other.ListDirectory(None))
+    self.assertEqual('css', other.GetFileContents('static/a.css'))
+    self.assertEqual(2, self._RefCount('app'))
+    self.tree.Clear()
+    self.assertEqual([], self.tree.ListDirectory(None))
+    self.assertEqual(1, self._RefCount('app'))
+    self.assertEqual('app', other.GetFileContents('app.yaml'))
+
+  def testMoveFile(self):
+    self.tree.SetFiles({'a.txt': 'a', 'b.txt': 'b'})
+    self.assertTrue(self.tree.MoveFile('a.txt', 'b.txt'))
+    self.assertEqual(['b.txt'], self.tree.ListDirectory(None))
+    self.assertEqual('a', self.tree.GetFileContents('b.txt'))
+    self.assertEqual(1, self._RefCount('a'))
+    self.assertEqual(0, self._RefCount('b'))
+    self.assertFalse(self.tree.MoveFile('missing', 'c.txt'))
+
+  def testMoveFileToItself(self):
+    self.tree.SetFile('a.txt', 'a')
+    self.assertTrue(self.tree.MoveFile('a.txt', 'a.txt'))
+    self.assertEqual('a', self.tree.GetFileContents('a.txt'))
+    self.assertEqual(1, self._RefCount('a'))
+
+  def testDeletePath(self):
+    self.tree.SetFiles({'static/a.css': 'css', 'static/js/app.js': 'js',
+                        'staticfile.txt': 'txt'})
+    self.assertTrue(self.tree.DeletePath('static'))
+    self.assertEqual(['staticfile.txt'], self.tree.ListDirectory(None))
+    self.assertEqual(0, self._RefCount('css'))
+    self.assertEqual(0, self._RefCount('js'))
+    self.assertEqual(1, self._RefCount('txt'))
+
+  def testListDirectory(self):
+    self.tree.SetFiles({'static/a.css': 'css', 'static/js/app.js': 'js',
+                        'staticfile.txt': 'txt', 'app.yaml': 'app'})
+    self.assertEqual(['static/a.css', 'static/js/app.js'],
+                     self.tree.ListDirectory('static'))
+    self.assertEqual(['static/js/app.js'],
+                     self.tree.ListDirectory('static/js/'))
+    self.assertTrue(self.tree.HasDirectory('static'))
+    self.assertFalse(self.tree.HasDirectory('lib'))
+
+  def testLargeBlob(self):
+    content = 'x' * (model._MAX_RAW_PROPERTY_BYTES + 1)
+    self.tree.SetFile('big.bin', content)
+    self.assertEqual(content, self.tree.GetFileContents('big.bin'))
+    self.assertEqual(2, self._NumChunks(content))
+    self.tree.DeletePath('big.bin')
+    self.assertEqual(0, self._NumChunks(content))
+    self.assertEqual(0, self._NumBlobs())
@@ -1,30 +1,90 @@
-"""URL Fetch Tree which caches responses during the current request."""
+"""URL Fetch Tree which caches responses across requests."""
 
 
+import httplib
 import os
 
+from . import lru
+from . import settings
 from . import urlfetch_tree
 
 
+# instance-wide cache of file responses, keyed by (namespace, path)
+_file_cache = lru.LruCache(settings.URLFETCH_FILE_CACHE_BYTES,
+                           sizeof=lambda resp: len(resp.content))
+
+
 class CachingUrlFetchTree(urlfetch_tree.UrlFetchTree):
-  """An caching implementation of URL Fetch Tree."""
+  """An caching implementation of URL Fetch Tree.
+
+  File responses are kept in an instance-wide cache. Cached responses are
+  revalidated with a conditional request the first time they are used in
+  each HTTP request, so only files which changed are downloaded again.
+  """
 
   def __init__(self, namespace, access_key):
     super(CachingUrlFetchTree, self).__init__(namespace, access_key)
+    # responses already validated during the current request
     self.file_cache = {}
+    # file metadata retrieved during the current request, None if missing
+    self.stat_cache = {}
     # uniquely identifies the current HTTP request
     self.request_log_id = os.environ['REQUEST_LOG_ID']
 
-  def RemoteGetFile(self, path):
-    # cache should not be used across multiple requests
+  def RemoteGetFile(self, path, headers=None):
+    # validated responses should not be used across multiple requests
     assert self.request_log_id == os.environ['REQUEST_LOG_ID']
     f = self.file_cache.get(path)
-    if not f:
-      f = super(CachingUrlFetchTree, self).RemoteGetFile(path)
-      self.file_cache[path] = f
+    if f:
+      return f
+    key = (self.namespace, path)
+    cached = _file_cache.Get(key)
+    headers = dict(headers or {})
+    if cached:
+      headers['If-None-Match'] = cached.headers['ETag']
+      if 'Last-Modified' in cached.headers:
+        headers['If-Modified-Since'] = cached.headers['Last-Modified']
+    f = super(CachingUrlFetchTree, self).RemoteGetFile(path, headers)
+    if f.status_code == httplib.NOT_MODIFIED and cached:
+      f = cached
+    elif f.status_code == httplib.OK and 'ETag' in f.headers:
+      _file_cache.Put(key, f)
+    else:
+      _file_cache.Pop(key)
+    self.file_cache[path] = f
     return f
 
+  def RemoteStat(self, paths):
+    assert self.request_log_id == os.environ['REQUEST_LOG_ID']
+    if paths is None:
+      return super(CachingUrlFetchTree, self).RemoteStat(None)
+    missing = [p for p in paths if p not in self.stat_cache]
+    if missing:
+      stats = super(CachingUrlFetchTree, self).RemoteStat(missing)
+      for path in missing:
+        self.stat_cache[path] = stats.get(path)
+    return dict((p, self.stat_cache[p]) for p in paths if self.stat_cache[p])
+
   def RemotePutFile(self, path, content):
     resp = super(CachingUrlFetchTree, self).RemotePutFile(path, content)
     self.file_cache.pop(path, None)
+    self.stat_cache.pop(path, None)
+    _file_cache.Pop((self.namespace, path))
     return resp
+
+  def RemotePutFiles(self, files):
+    super(CachingUrlFetchTree, self).RemotePutFiles(files)
+    for path, _ in files:
+      self.file_cache.pop(path, None)
+      self.stat_cache.pop(path, None)
+      _file_cache.Pop((self.namespace, path))
+
+  def MoveFile(self, path, newpath):
+    self.file_cache.clear()
+    self.stat_cache.clear()
+    return super(CachingUrlFetchTree, self).MoveFile(path, newpath)
+
+  def DeletePath(self, path):
+    self.file_cache.clear()
+    self.stat_cache.clear()
+    return super(CachingUrlFetchTree, self).DeletePath(path)
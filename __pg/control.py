@@ -0,0 +1,127 @@
+"""Module containing mimic control handlers implemented by the playground."""
+
+import base64
+import hashlib
+import httplib
+
+import webapp2
+
+from mimic.__mimic import common
+from mimic.__mimic import mimic
+
+from error import Abort
+from . import jsonutil
+from . import settings
+
+
+# batch file retrieval and update
+FILES_PATH = '{}/files'.format(common.CONTROL_PREFIX)
+
+# file metadata retrieval
+STAT_PATH = '{}/stat'.format(common.CONTROL_PREFIX)
+
+# control paths served by this module, all of which require a tree
+CONTROL_PATHS = frozenset([
+    FILES_PATH,
+    STAT_PATH,
+])
+
+
+def GetFileStats(tree, paths):
+  """Get size, last modified time and SHA-1 content hash of files.
+
+  Uses the tree's own GetFileStats() where available, which does not read
+  file contents.
+
+  Args:
+    tree: The tree.
+    paths: A list of file paths or None for the entire tree.
+
+  Returns:
+    A dict mapping each existing path to a dict with 'size', 'mtime' and
+    'hash'.
+  """
+  if hasattr(tree, 'GetFileStats'):
+    return tree.GetFileStats(paths)
+  if paths is None:
+    paths = [p for p in tree.ListDirectory(None) if not p.endswith('/')]
+  stats = {}
+  for path in paths:
+    contents = tree.GetFileContents(path)
+    if contents is None:
+      continue
+    stats[path] = {
+        'size': len(contents),
+        'mtime': tree.GetFileLastModified(path),
+        'hash': hashlib.sha1(contents).hexdigest(),
+    }
+  return stats
+
+
+class ControlHandler(webapp2.RequestHandler):
+  """Convenience request handler for mimic control requests.
+
+  Access checks are performed by middleware.MimicControlAccessFilter.
+  """
+
+  @webapp2.cached_property
+  def tree(self):  # pylint:disable-msg=invalid-name
+    project_id = mimic.GetProjectId(self.request.environ, False)
+    if not project_id:
+      Abort(httplib.BAD_REQUEST, 'Missing project id')
+    access_key = self.request.environ.get('mimic.access_key', '')
+    return common.config.CREATE_TREE_FUNC(str(project_id), access_key)
+
+  def WriteJson(self, r):
+    self.response.headers['Content-Type'] = jsonutil.JSON_MIME_TYPE
+    self.response.write(jsonutil.tojson(r))
+
+
+class Files(ControlHandler):
+  """Handler for retrieving or updating many files in one request.
+
+  File contents are base64 encoded JSON strings keyed by path.
+  """
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    files = {}
+    for path in self.request.GET.getall('path'):
+      contents = self.tree.GetFileContents(path)
+      if contents is not None:
+        files[path] = base64.b64encode(contents)
+    self.WriteJson({'files': files})
+
+  def put(self):  # pylint:disable-msg=invalid-name
+    files = jsonutil.fromjson(self.request.body)
+    if not isinstance(files, dict):
+      Abort(httplib.BAD_REQUEST, 'Expected a JSON object of files')
+    files = dict((path, base64.b64decode(contents))
+                 for path, contents in files.iteritems())
+    if hasattr(self.tree, 'SetFiles'):
+      self.tree.SetFiles(files)
+    else:
+      for path, contents in files.iteritems():
+        self.tree.SetFile(path, contents)
+    self.WriteJson({'count': len(files)})
+
+
+class Stat(ControlHandler):
+  """Handler for retrieving file metadata without file contents.
+
+  Returns the size, last modified time and SHA-1 content hash of the
+  requested paths, or of every file in the tree if no path is given.
+  """
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    paths = self.request.GET.getall('path') or None
+    stats = GetFileStats(self.tree, paths)
+    for stat in stats.itervalues():
+      if stat['mtime']:
+        stat['mtime'] = stat['mtime'].strftime(common.RFC_1123_DATE_FORMAT)
+    self.WriteJson({'files': stats})
+
+
+app = webapp2.WSGIApplication([
+    (FILES_PATH, Files),
+    (STAT_PATH, Stat),
+], debug=settings.DEBUG)
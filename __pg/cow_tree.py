@@ -0,0 +1,313 @@
+"""A copy-on-write project tree layered on top of an immutable snapshot."""
+
+
+from mimic.__mimic import common
+from mimic.__mimic import datastore_tree
+
+from . import blob_tree
+from . import model
+from . import shared
+
+
+class CopyOnWriteTree(common.Tree):
+  """A mutable project tree which reads through to a snapshot tree.
+
+  Files are materialized in the project's own tree the first time they are
+  written. Deleting or moving a snapshot file detaches the project from its
+  snapshot, materializing all remaining snapshot files first.
+
+  All writes advance the project's content_updated high-water mark.
+  """
+
+  def __init__(self, namespace, access_key, project, tree, base_tree=None):
+    super(CopyOnWriteTree, self).__init__(namespace, access_key)
+    self.namespace = namespace
+    self.access_key = access_key
+    self._project = project
+    self._tree = tree
+    self._base_tree = base_tree
+
+  def __repr__(self):
+    return ('<{0} namespace={1!r} base_tree={2!r}>'
+            .format(self.__class__.__name__, self.namespace, self._base_tree))
+
+  def _TreeFor(self, path):
+    """Returns the tree which holds the current version of a file."""
+    if not self._base_tree or self._tree.HasFile(path):
+      return self._tree
+    return self._base_tree
+
+  def _Detach(self):
+    """Materialize all snapshot files and stop reading from the snapshot."""
+    materialized = set(self._tree.ListDirectory(None))
+    files = [f for f in self._base_tree.GetFiles(None)
+             if f.key.id() not in materialized]
+    self._tree.PutFiles(files)
+    shared.i('detached {} from {}'.format(self.namespace, self._base_tree))
+    self._project = model.SetProjectBaseSnapshot(self._project.key, None)
+    self._base_tree = None
+
+  def _ContentUpdated(self):
+    self._project = model.MarkProjectContentUpdated(self._project)
+
+  def _HasBasePath(self, path):
+    return self._base_tree and (self._base_tree.HasFile(path) or
+                                self._base_tree.HasDirectory(path))
+
+  def IsMutable(self):
+    return True
+
+  def GetFileContents(self, path):
+    return self._TreeFor(path).GetFileContents(path)
+
+  def GetFileSize(self, path):
+    return self._TreeFor(path).GetFileSize(path)
+
+  def GetFileLastModified(self, path):
+    return self._TreeFor(path).GetFileLastModified(path)
+
+  def HasFile(self, path):
+    if self._tree.HasFile(path):
+      return True
+    return bool(self._base_tree) and self._base_tree.HasFile(path)
+
+  def MoveFile(self, path, newpath):
+    if self._HasBasePath(path):
+      self._Detach()
+    self._ContentUpdated()
+    return self._tree.MoveFile(path, newpath)
+
+  def DeletePath(self, path):
+    if self._HasBasePath(path):
+      self._Detach()
+    self._ContentUpdated()
+    return self._tree.DeletePath(path)
+
+  def Clear(self):
+    self._tree.Clear()
+    if self._base_tree:
+      self._project = model.SetProjectBaseSnapshot(self._project.key, None)
+      self._base_tree = None
+    self._ContentUpdated()
+
+  def SetFile(self, path, contents):
+    self._ContentUpdated()
+    self._tree.SetFile(path, contents)
+
+  def SetFiles(self, files):
+    self._ContentUpdated()
+    self._tree.SetFiles(files)
+
+  def GetFiles(self, path):
+    files = dict((f.key.id(), f) for f in self._tree.GetFiles(path))
+    if self._base_tree:
+      # materialized files take precedence over their snapshot versions
+      for f in self._base_tree.GetFiles(path):
+        files.setdefault(f.key.id(), f)
+    return files.values()
+
+  def PutFiles(self, files):
+    self._ContentUpdated()
+    self._tree.PutFiles(files)
+
+  def GetFileStats(self, paths):
+    stats = {}
+    if self._base_tree:
+      stats.update(self._base_tree.GetFileStats(paths))
+    stats.update(self._tree.GetFileStats(paths))
+    return stats
+
+  def HasDirectory(self, path):
+    if self._tree.HasDirectory(path):
+      return True
+    return bool(self._base_tree) and self._base_tree.HasDirectory(path)
+
+  def ListDirectory(self, path):
+    paths = set(self._tree.ListDirectory(path))
+    if self._base_tree:
+      paths.update(self._base_tree.ListDirectory(path))
+    return sorted(paths)
+
+
+class StagingTree(common.Tree):
+  """A snapshot tree in which a template project is rebuilt.
+
+  The staging tree starts out with the same files as the template's current
+  tree. The snapshot is allocated and those files are copied by reference
+  before the first change, so a rebuild which changes nothing writes nothing.
+  Clear() skips the copy.
+  """
+
+  def __init__(self, template_project, base_tree, namespace=None):
+    super(StagingTree, self).__init__(namespace, '')
+    self.namespace = namespace
+    self.access_key = ''
+    self._template_project = template_project
+    self._tree = namespace and blob_tree.BlobTree(namespace)
+    self._base_tree = base_tree
+    self.changed = False
+
+  def __repr__(self):
+    return ('<{0} namespace={1!r} base_tree={2!r}>'
+            .format(self.__class__.__name__, self.namespace, self._base_tree))
+
+  def _ReadTree(self):
+    return self._base_tree or self._tree
+
+  def _Allocate(self):
+    if not self.namespace:
+      self.namespace = model.NewTemplateSnapshot(self._template_project)
+      self._tree = blob_tree.BlobTree(self.namespace)
+
+  def Materialize(self):
+    """Copy the template's current files before the first change."""
+    self._Allocate()
+    self.changed = True
+    if self._base_tree:
+      model.CopyTree(self._tree, self._base_tree)
+      self._base_tree = None
+
+  def IsMutable(self):
+    return True
+
+  def GetFileContents(self, path):
+    return self._ReadTree().GetFileContents(path)
+
+  def GetFileSize(self, path):
+    return self._ReadTree().GetFileSize(path)
+
+  def GetFileLastModified(self, path):
+    return self._ReadTree().GetFileLastModified(path)
+
+  def HasFile(self, path):
+    return self._ReadTree().HasFile(path)
+
+  def HasDirectory(self, path):
+    return self._ReadTree().HasDirectory(path)
+
+  def ListDirectory(self, path):
+    return self._ReadTree().ListDirectory(path)
+
+  def MoveFile(self, path, newpath):
+    self.Materialize()
+    return self._tree.MoveFile(path, newpath)
+
+  def DeletePath(self, path):
+    self.Materialize()
+    return self._tree.DeletePath(path)
+
+  def Clear(self):
+    self._Allocate()
+    self.changed = True
+    self._base_tree = None
+    self._tree.Clear()
+
+  def SetFile(self, path, contents):
+    self.Materialize()
+    self._tree.SetFile(path, contents)
+
+  def SetFiles(self, files):
+    self.Materialize()
+    self._tree.SetFiles(files)
+
+
+def CreateStagingTree(template_project, resume=False):
+  """Creates a tree in which to rebuild a template project's files.
+
+  Args:
+    template_project: The template project.
+    resume: Whether to continue writing to the staging snapshot of a
+        deferred population, which already holds changes.
+
+  Returns:
+    A StagingTree, to be passed to PublishStagingTree() once complete.
+  """
+  if resume:
+    tree = StagingTree(template_project, None,
+                       namespace=template_project.staging_snapshot)
+    tree.changed = True
+    return tree
+  # templates populated before staging was introduced hold their own files
+  current = (template_project.base_snapshot or
+             str(template_project.key.id()))
+  return StagingTree(template_project, blob_tree.BlobTree(current))
+
+
+def PublishStagingTree(template_project_key, tree):
+  """Atomically switch a template project to a completed staging tree.
+
+  Args:
+    template_project_key: The template project key.
+    tree: The StagingTree.
+
+  Returns:
+    The template project.
+  """
+  if not tree.changed:
+    DiscardStagingTree(template_project_key, tree)
+    return template_project_key.get()
+  project = model.SetTemplateSnapshot(template_project_key, tree.namespace)
+  # files written in place by earlier populations would shadow the snapshot
+  blob_tree.BlobTree(str(template_project_key.id())).Clear()
+  return project
+
+
+def MigrateLegacyFiles(project):
+  """Move project files from the legacy mimic datastore tree to a blob tree.
+
+  Args:
+    project: The playground project.
+
+  Returns:
+    The updated project entity.
+  """
+  namespace = str(project.key.id())
+  legacy_tree = datastore_tree.DatastoreTree(namespace)
+  paths = [p for p in legacy_tree.ListDirectory(None) if not p.endswith('/')]
+  if paths:
+    blob_tree.BlobTree(namespace).SetFiles(
+        dict((path, legacy_tree.GetFileContents(path)) for path in paths))
+  project = model.MarkProjectFilesMigrated(project.key)
+  if paths:
+    legacy_tree.Clear()
+    shared.w('migrated {} files of {}'.format(len(paths), project.key))
+  return project
+
+
+def DiscardStagingTree(template_project_key, tree):
+  """Abandon a staging tree which is not to be published.
+
+  Args:
+    template_project_key: The template project key.
+    tree: The StagingTree.
+  """
+  if not tree.namespace:
+    # no snapshot was allocated, as nothing was written
+    return
+  shared.i('discarding staging tree {}'.format(tree.namespace))
+  model.DiscardTemplateSnapshot(template_project_key, tree.namespace)
+
+
+def CreateTree(namespace, access_key=''):
+  """Creates the tree for a project or snapshot namespace.
+
+  Args:
+    namespace: The project id or snapshot tree namespace.
+    access_key: The project access key.
+
+  Returns:
+    A CopyOnWriteTree for projects, or the plain snapshot tree.
+  """
+  tree = blob_tree.BlobTree(namespace, access_key)
+  # cached projects are validated, so they never read through to a snapshot
+  # they have detached from
+  project = model.GetCachedProject(namespace)
+  if not project:
+    return tree
+  if not project.blob_files:
+    # projects created before blob trees are migrated on first access
+    project = MigrateLegacyFiles(project)
+  base_tree = None
+  if project.base_snapshot:
+    base_tree = blob_tree.BlobTree(project.base_snapshot, access_key)
+  return CopyOnWriteTree(namespace, access_key, project, tree, base_tree)
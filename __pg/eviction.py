@@ -0,0 +1,120 @@
+"""Module which evicts least recently used cached web resources."""
+
+import datetime
+import time
+
+import webapp2
+
+from mimic.__mimic import common
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext.ndb import stats as datastore_stats
+
+from . import jsonutil
+from . import model
+from . import settings
+from . import shared
+
+
+# number of resources to check at a time; resources may be up to 1MB each
+_CURSOR_PAGE_SIZE = 20
+
+# memcache key prefix for eviction counters
+_MEMCACHE_KEY_STATS = 'eviction_stats_'
+
+_STATS = ('checked', 'evicted', 'bytes_reclaimed')
+
+
+def Begin():
+  """Start an eviction pass over the Resource cache.
+
+  Evicts the least recently used resources in excess of
+  RESOURCE_CACHE_MAX_ENTRIES, and all resources which have not been accessed
+  for RESOURCE_CACHE_MAX_AGE_SECONDS.
+  """
+  count = _GetApproximateResourceCount()
+  excess = max(0, (count or 0) - settings.RESOURCE_CACHE_MAX_ENTRIES)
+  cutoff = time.time() - settings.RESOURCE_CACHE_MAX_AGE_SECONDS
+  shared.i('evicting {} of {} resources plus any accessed before {}'
+           .format(excess, count, datetime.datetime.fromtimestamp(cutoff)))
+  taskqueue.add(queue_name='eviction', url='/playground/eviction/sweep',
+                params={'excess': excess, 'cutoff': cutoff})
+
+
+def _GetApproximateResourceCount():
+  """Returns the number of resources according to the datastore statistics.
+
+  The statistics are only updated about once a day, which is accurate enough
+  to bound the cache without counting every resource on each pass.
+
+  Returns:
+    The approximate number of resources, or None if no statistics exist yet.
+  """
+  stat_kind = datastore_stats.NamespaceKindStat
+  stat = stat_kind.query(stat_kind.kind_name == 'Resource',
+                         namespace=settings.PLAYGROUND_NAMESPACE).get()
+  return stat and stat.count
+
+
+def GetStats():
+  return shared.GetStats(_MEMCACHE_KEY_STATS, _STATS)
+
+
+class BeginHandler(webapp2.RequestHandler):
+
+  def get(self):  # pylint:disable-msg=invalid-name,missing-docstring
+    Begin()
+    self.response.write('Resource eviction begun')
+
+
+class SweepHandler(webapp2.RequestHandler):
+
+  def post(self):  # pylint:disable-msg=invalid-name,missing-docstring
+    assert self.request.environ[common.HTTP_X_APPENGINE_QUEUENAME]
+    started = time.time()
+    excess = int(self.request.get('excess'))
+    cutoff = float(self.request.get('cutoff'))
+    cutoff_date = datetime.datetime.fromtimestamp(cutoff)
+    query = model.Resource.query(namespace=settings.PLAYGROUND_NAMESPACE)
+    query = query.order(model.Resource.last_accessed)
+    cursor = self.request.get('cursor', None)
+    if cursor:
+      cursor = Cursor(urlsafe=cursor)
+    resources, next_cursor, more = query.fetch_page(_CURSOR_PAGE_SIZE,
+                                                    start_cursor=cursor)
+    evicted = []
+    for resource in resources:
+      if excess <= len(evicted) and resource.last_accessed >= cutoff_date:
+        # all remaining resources are more recently used
+        more = False
+        break
+      evicted.append(resource)
+    if more and next_cursor:
+      taskqueue.add(queue_name='eviction',
+                    url='/playground/eviction/sweep',
+                    params={'excess': max(0, excess - len(evicted)),
+                            'cutoff': cutoff,
+                            'cursor': next_cursor.urlsafe()})
+    reclaimed = model.DeleteResources(evicted)
+    elapsed = time.time() - started
+    shared.IncrementStats(_MEMCACHE_KEY_STATS,
+                          {'checked': len(resources), 'evicted': len(evicted),
+                           'bytes_reclaimed': reclaimed}, elapsed)
+    shared.i('evicted {} of {} resources, reclaiming {} bytes in {:.1f}s'
+             .format(len(evicted), len(resources), reclaimed, elapsed))
+
+
+class StatsHandler(webapp2.RequestHandler):
+
+  def get(self):  # pylint:disable-msg=invalid-name,missing-docstring
+    stats = GetStats()
+    self.response.headers['Content-Type'] = jsonutil.JSON_MIME_TYPE
+    self.response.write(jsonutil.tojson(stats))
+
+
+app = webapp2.WSGIApplication([
+    ('/playground/eviction/begin', BeginHandler),
+    ('/playground/eviction/sweep', SweepHandler),
+    ('/playground/eviction/stats', StatsHandler),
+], debug=True)
@@ -0,0 +1,93 @@
+"""Module which deletes expired projects in batches."""
+
+import datetime
+import time
+
+import webapp2
+
+from mimic.__mimic import common
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from . import jsonutil
+from . import model
+from . import settings
+from . import shared
+
+
+# number of projects to check at a time
+_CURSOR_PAGE_SIZE = 50
+
+# memcache key prefix for sweeper counters
+_MEMCACHE_KEY_STATS = 'expiration_stats_'
+
+_STATS = ('checked', 'deleted')
+
+
+def Begin():
+  for shard in range(0, settings.EXPIRATION_SHARDS):
+    taskqueue.add(queue_name='expiration', url='/playground/expiration/sweep',
+                  params={'shard': shard})
+
+
+def GetStats():
+  return shared.GetStats(_MEMCACHE_KEY_STATS, _STATS)
+
+
+class BeginHandler(webapp2.RequestHandler):
+
+  def get(self):  # pylint:disable-msg=invalid-name,missing-docstring
+    Begin()
+    self.response.write('Expiration sweep begun')
+
+
+class SweepHandler(webapp2.RequestHandler):
+
+  def post(self):  # pylint:disable-msg=invalid-name,missing-docstring
+    assert self.request.environ[common.HTTP_X_APPENGINE_QUEUENAME]
+    started = time.time()
+    shard = int(self.request.get('shard'))
+    now = datetime.datetime.now()
+    query = model.Project.query(model.Project.expiration_shard == shard,
+                                model.Project.expires < now,
+                                namespace=settings.PLAYGROUND_NAMESPACE)
+    cursor = self.request.get('cursor', None)
+    if cursor:
+      cursor = Cursor(urlsafe=cursor)
+    keys, next_cursor, more = query.fetch_page(_CURSOR_PAGE_SIZE,
+                                               start_cursor=cursor,
+                                               keys_only=True)
+    if more and next_cursor:
+      taskqueue.add(queue_name='expiration',
+                    url='/playground/expiration/sweep',
+                    params={'shard': shard, 'cursor': next_cursor.urlsafe()})
+    deleted = 0
+    # the index may be stale; re-check the current entities
+    for project in ndb.get_multi(keys):
+      if project and model.CheckExpiration(project):
+        deleted += 1
+    elapsed = time.time() - started
+    shared.IncrementStats(_MEMCACHE_KEY_STATS,
+                          {'checked': len(keys), 'deleted': deleted}, elapsed)
+    shared.i('expiration shard {} deleted {} of {} projects in {:.1f}s '
+             '({:.1f} projects/s)'.format(shard, deleted, len(keys), elapsed,
+                                          deleted / max(elapsed, 0.001)))
+
+
+class StatsHandler(webapp2.RequestHandler):
+
+  def get(self):  # pylint:disable-msg=invalid-name,missing-docstring
+    stats = GetStats()
+    stats['projects_per_second'] = (1000.0 * stats['deleted'] /
+                                    max(stats['milliseconds'], 1))
+    self.response.headers['Content-Type'] = jsonutil.JSON_MIME_TYPE
+    self.response.write(jsonutil.tojson(stats))
+
+
+app = webapp2.WSGIApplication([
+    ('/playground/expiration/begin', BeginHandler),
+    ('/playground/expiration/sweep', SweepHandler),
+    ('/playground/expiration/stats', StatsHandler),
+], debug=True)
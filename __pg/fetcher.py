@@ -1,12 +1,46 @@
 """Module for url fetching functions."""
 
+import collections
 import httplib
 import json
+import os
+import random
+import threading
+import time
+import urlparse
 
 from . import model
+from . import settings
 from . import shared
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+
+# memcache key prefix for cross-instance url fetch leases
+_LEASE_MEMCACHE_PREFIX = 'fetch_lease_'
+
+# lease value while the leader's fetch is outstanding; afterwards the lease
+# holds the ETag of the stored resource
+_LEASE_PENDING = ''
+
+# memcache key prefixes for the rate limit budget of each host
+_RATE_LIMIT_REMAINING_MEMCACHE_PREFIX = 'rate_limit_remaining_'
+_RATE_LIMIT_RESET_MEMCACHE_PREFIX = 'rate_limit_reset_'
+
+# memcache key prefix for rate limited fetches by usage key
+_RATE_LIMIT_USAGE_MEMCACHE_PREFIX = 'rate_limit_usage_'
+
+# not defined by httplib
+_TOO_MANY_REQUESTS = 429
+
+# per request state: fetches in flight and the rate limit usage key
+_local = threading.local()
+
+# X-RateLimit-Limit of the hosts which sent rate limit headers to this
+# instance; fetches to other hosts are not counted against a budget
+_rate_limits = {}
 
 
 # pylint:disable-msg=nonstandard-exception
@@ -23,40 +57,496 @@ class FetchError(urlfetch.Error):
                                                      self.response.content)
 
 
+class RateLimitError(Exception):
+  """The rate limit budget of a host is exhausted."""
+
+  def __init__(self, host, reset):
+    super(RateLimitError, self).__init__()
+    self.host = host
+    # POSIX timestamp at which the budget is replenished
+    self.reset = reset
+
+  def __str__(self):
+    return 'Rate limit for {} exhausted until {}'.format(
+        self.host, time.strftime('%H:%M:%S UTC', time.gmtime(self.reset)))
+
+
+def _LeaseMemcacheKey(url):
+  return '{}{}'.format(_LEASE_MEMCACHE_PREFIX, url)
+
+
+def _ReleaseLeases(etags):
+  """Publish the outcome of leased fetches to followers in other instances.
+
+  Args:
+    etags: A dict mapping urls to the ETag of the stored resource, or to None
+        if no resource was stored.
+  """
+  stored = dict((_LeaseMemcacheKey(url), etag)
+                for url, etag in etags.iteritems() if etag)
+  failed = [_LeaseMemcacheKey(url)
+            for url, etag in etags.iteritems() if not etag]
+  if stored:
+    memcache.set_multi(stored, time=settings.FETCH_LEASE_SECONDS,
+                       namespace=settings.PLAYGROUND_NAMESPACE)
+  if failed:
+    memcache.delete_multi(failed, namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def _GetRequestLocal():
+  """Returns the fetcher state of the current request."""
+  request_log_id = os.environ.get('REQUEST_LOG_ID')
+  if getattr(_local, 'request_log_id', None) != request_log_id:
+    # futures are bound to the event loop of the request which created them
+    _local.request_log_id = request_log_id
+    _local.flights = {}
+    _local.usage_key = None
+  return _local
+
+
+def _GetFlights():
+  """Returns a dict of the fetches in flight in the current request."""
+  return _GetRequestLocal().flights
+
+
+def SetUsageKey(usage_key):
+  """Attribute rate limited fetches in the current request to a usage key.
+
+  Args:
+    usage_key: For example the url of a repo collection.
+  """
+  _GetRequestLocal().usage_key = usage_key
+
+
+def GetRateLimit(host):
+  """Get the last known rate limit budget of a host.
+
+  Args:
+    host: The host name.
+
+  Returns:
+    A dict with the 'remaining' fetches and the POSIX timestamp at which the
+    budget is 'reset', or None if the budget is unknown.
+  """
+  remaining_key = _RATE_LIMIT_REMAINING_MEMCACHE_PREFIX + host
+  reset_key = _RATE_LIMIT_RESET_MEMCACHE_PREFIX + host
+  budget = memcache.get_multi([remaining_key, reset_key],
+                              namespace=settings.PLAYGROUND_NAMESPACE)
+  if remaining_key not in budget:
+    return None
+  return {'remaining': budget[remaining_key],
+          'reset': budget.get(reset_key)}
+
+
+def GetUsage(usage_keys):
+  """Get the number of rate limited fetches attributed to each usage key.
+
+  Args:
+    usage_keys: The usage keys.
+
+  Returns:
+    A dict mapping each usage key to a count.
+  """
+  usage = memcache.get_multi(usage_keys,
+                             key_prefix=_RATE_LIMIT_USAGE_MEMCACHE_PREFIX,
+                             namespace=settings.PLAYGROUND_NAMESPACE)
+  return dict((k, usage.get(k, 0)) for k in usage_keys)
+
+
+@ndb.tasklet
+def _SpendRateLimitAsync(host):
+  """Take one fetch from the shared budget of a host.
+
+  A fraction of the host's rate limit is held back as a margin for fetches
+  already in flight.
+
+  Args:
+    host: The host name.
+
+  Returns:
+    True if the fetch was taken from the budget, False if the host is not
+    known to be rate limited.
+
+  Raises:
+    RateLimitError: If the budget is exhausted until a future reset.
+  """
+  limit = _rate_limits.get(host)
+  if limit is None:
+    raise ndb.Return(False)
+  context = ndb.get_context()
+  remaining = yield context.memcache_decr(
+      _RATE_LIMIT_REMAINING_MEMCACHE_PREFIX + host,
+      namespace=settings.PLAYGROUND_NAMESPACE)
+  reserve = max(1, int(limit * settings.RATE_LIMIT_RESERVE_FRACTION))
+  if remaining is None or remaining > reserve:
+    raise ndb.Return(True)
+  reset = yield context.memcache_get(_RATE_LIMIT_RESET_MEMCACHE_PREFIX + host,
+                                     namespace=settings.PLAYGROUND_NAMESPACE)
+  if reset and reset > time.time():
+    raise RateLimitError(host, reset)
+  raise ndb.Return(True)
+
+
+@ndb.tasklet
+def _RecordRateLimitAsync(host, response, usage_key, spent):
+  """Update the shared budget of a host from rate limit response headers.
+
+  Args:
+    host: The host name.
+    response: The URL Fetch response.
+    usage_key: The usage key to attribute the fetch to, or None.
+    spent: Whether _SpendRateLimitAsync() took the fetch from the budget.
+
+  Raises:
+    RateLimitError: If the response was refused due to the rate limit.
+  """
+  context = ndb.get_context()
+  if spent and response.status_code == httplib.NOT_MODIFIED:
+    # conditional requests answered with 304 do not count against the limit;
+    # refund the fetch taken by _SpendRateLimitAsync()
+    yield context.memcache_incr(_RATE_LIMIT_REMAINING_MEMCACHE_PREFIX + host,
+                                namespace=settings.PLAYGROUND_NAMESPACE)
+  remaining = response.headers.get('X-RateLimit-Remaining')
+  reset = response.headers.get('X-RateLimit-Reset')
+  if remaining is None or reset is None:
+    return
+  remaining = int(remaining)
+  reset = int(reset)
+  _rate_limits[host] = int(response.headers.get('X-RateLimit-Limit',
+                                                remaining))
+  # the budget is forgotten once it is replenished
+  rpcs = [
+      context.memcache_set(_RATE_LIMIT_REMAINING_MEMCACHE_PREFIX + host,
+                           remaining, time=reset,
+                           namespace=settings.PLAYGROUND_NAMESPACE),
+      context.memcache_set(_RATE_LIMIT_RESET_MEMCACHE_PREFIX + host,
+                           reset, time=reset,
+                           namespace=settings.PLAYGROUND_NAMESPACE),
+  ]
+  if usage_key and response.status_code != httplib.NOT_MODIFIED:
+    rpcs.append(context.memcache_incr(
+        _RATE_LIMIT_USAGE_MEMCACHE_PREFIX + usage_key, initial_value=0,
+        namespace=settings.PLAYGROUND_NAMESPACE))
+  yield rpcs
+  if (not remaining and
+      response.status_code in (httplib.FORBIDDEN, _TOO_MANY_REQUESTS)):
+    raise RateLimitError(host, reset)
+
+
+class _Flight(object):
+  """A single url fetch shared by all identical Fetchers in a request."""
+
+  def __init__(self, url):
+    self.url = url
+    self.future = None
+    # whether this flight holds the cross-instance lease for url
+    self.leased = False
+    # whether the response content has been stored by one of the Fetchers
+    self.stored = False
+
+  def Release(self, etag):
+    if self.leased:
+      self.leased = False
+      _ReleaseLeases({self.url: etag})
+
+
+@ndb.tasklet
+def _AwaitLeaseAsync(url):
+  """Wait for the leader of a url fetch in another instance.
+
+  Args:
+    url: The url being fetched.
+
+  Returns:
+    A future for the ETag of the resource stored by the leader, or None if
+    the leader stored nothing or did not finish in time.
+  """
+  context = ndb.get_context()
+  deadline = time.time() + settings.FETCH_LEASE_WAIT_SECONDS
+  while True:
+    value = yield context.memcache_get(_LeaseMemcacheKey(url),
+                                       namespace=settings.PLAYGROUND_NAMESPACE)
+    if value != _LEASE_PENDING:
+      raise ndb.Return(value)
+    if time.time() >= deadline:
+      shared.w('gave up waiting for another instance to fetch {}'.format(url))
+      raise ndb.Return(None)
+    yield ndb.sleep(settings.FETCH_LEASE_POLL_SECONDS)
+
+
+@ndb.tasklet
+def _FlyAsync(flight, etag, content, full_url, follow_redirects, headers,
+              deadline, scheduler):
+  """Fetch a url, unless another instance is already fetching it.
+
+  Args:
+    flight: The _Flight for the url.
+    etag: The ETag of the cached resource, if any.
+    content: The content of the cached resource, if any.
+    full_url: The url including any authentication query parameters.
+    follow_redirects: Whether to follow redirects.
+    headers: Request headers.
+    deadline: The URL Fetch deadline in seconds, or None for the default.
+    scheduler: The FetchScheduler to issue the URL Fetch through, or None.
+
+  Returns:
+    A future for a (response, etag, content) tuple. The response is None if
+    the content was stored by the leader in another instance.
+
+  Raises:
+    RateLimitError: If the rate limit budget of the host is exhausted.
+  """
+  context = ndb.get_context()
+  host = urlparse.urlsplit(full_url).netloc
+  usage_key = _GetRequestLocal().usage_key
+  flight.leased = yield context.memcache_add(
+      _LeaseMemcacheKey(flight.url), _LEASE_PENDING,
+      time=settings.FETCH_LEASE_SECONDS,
+      namespace=settings.PLAYGROUND_NAMESPACE)
+  if not flight.leased:
+    leader_etag = yield _AwaitLeaseAsync(flight.url)
+    if leader_etag and leader_etag != etag:
+      etag, content = yield model.GetResourceAsync(flight.url)
+    if leader_etag and leader_etag == etag:
+      raise ndb.Return((None, etag, content))
+  if etag:
+    headers['If-None-Match'] = '{}'.format(etag)
+  # shared.i('urlfetch {} {}'.format(headers, full_url))
+  urlfetch_async = scheduler.FetchAsync if scheduler else context.urlfetch
+  try:
+    spent = yield _SpendRateLimitAsync(host)
+    response = yield urlfetch_async(
+        full_url, headers=headers, follow_redirects=follow_redirects,
+        validate_certificate=True, deadline=deadline)
+    yield _RecordRateLimitAsync(host, response, usage_key, spent)
+  except Exception:  # pylint:disable-msg=broad-except
+    flight.Release(None)
+    raise
+  raise ndb.Return((response, etag, content))
+
+
+@ndb.tasklet
+def FetchUncachedAsync(url, url_auth_suffix='', follow_redirects=False,
+                       headers=None, deadline=None):
+  """Fetch a url once, bypassing the Resource cache.
+
+  Meant for large responses which are only read once, such as archives,
+  and which would only crowd the cache. The fetch is still charged to the
+  rate limit budget of the host.
+
+  Args:
+    url: The url to fetch.
+    url_auth_suffix: Authentication query parameters appended to the url.
+    follow_redirects: Whether to follow redirects.
+    headers: Request headers.
+    deadline: The URL Fetch deadline in seconds, or None for the default.
+
+  Returns:
+    A future for the URL Fetch response.
+
+  Raises:
+    FetchError: If the response is truncated or not 200 OK.
+    RateLimitError: If the rate limit budget of the host is exhausted.
+  """
+  host = urlparse.urlsplit(url).netloc
+  spent = yield _SpendRateLimitAsync(host)
+  response = yield ndb.get_context().urlfetch(
+      '{}{}'.format(url, url_auth_suffix), headers=headers or {},
+      follow_redirects=follow_redirects, validate_certificate=True,
+      deadline=deadline)
+  yield _RecordRateLimitAsync(host, response, _GetRequestLocal().usage_key,
+                              spent)
+  shared.i('{} {}'.format(response.status_code, url))
+  if (response.content_was_truncated or
+      response.status_code != httplib.OK):
+    raise FetchError(url, response)
+  raise ndb.Return(response)
+
+
+class FetchScheduler(object):
+  """Bounds the concurrency of URL Fetch calls and retries failed ones.
+
+  At most max_in_flight fetches, and at most max_per_host fetches to any one
+  host, are outstanding at once. Further fetches wait their turn in order,
+  but fetches waiting on a busy host do not hold up other hosts.
+  Fetches which fail with a URL Fetch error or a 5xx response are retried
+  with jittered exponential backoff. Progress is logged as fetches complete.
+  """
+
+  def __init__(self, name='',
+               max_in_flight=settings.FETCH_MAX_IN_FLIGHT,
+               max_per_host=settings.FETCH_MAX_IN_FLIGHT_PER_HOST,
+               retries=settings.FETCH_RETRIES):
+    self.name = name
+    self.max_in_flight = max_in_flight
+    self.max_per_host = max_per_host
+    self.retries = retries
+    self.total = 0
+    self.completed = 0
+    self.failed = 0
+    self.retried = 0
+    self._in_flight = 0
+    self._in_flight_per_host = collections.defaultdict(int)
+    # (host, future) of fetches waiting for room in the window
+    self._waiting = collections.deque()
+
+  def _HasRoom(self, host):
+    return (self._in_flight < self.max_in_flight and
+            self._in_flight_per_host[host] < self.max_per_host)
+
+  def _Admit(self, host, future):
+    self._in_flight += 1
+    self._in_flight_per_host[host] += 1
+    future.set_result(None)
+
+  def _AcquireAsync(self, host):
+    future = ndb.Future()
+    # fetches to the same host are admitted in order
+    if (self._HasRoom(host) and
+        not any(waiting[0] == host for waiting in self._waiting)):
+      self._Admit(host, future)
+    else:
+      self._waiting.append((host, future))
+    return future
+
+  def _Release(self, host):
+    self._in_flight -= 1
+    self._in_flight_per_host[host] -= 1
+    # waiting fetches to a busy host do not hold up other hosts
+    for waiting in list(self._waiting):
+      if self._HasRoom(waiting[0]):
+        self._waiting.remove(waiting)
+        self._Admit(*waiting)
+
+  def _ReportProgress(self):
+    done = self.completed + self.failed
+    if done == self.total or not done % settings.FETCH_PROGRESS_INTERVAL:
+      shared.i('{} fetched {} of {} urls, {} failed, {} retried'
+               .format(self.name, self.completed, self.total, self.failed,
+                       self.retried))
+
+  @ndb.tasklet
+  def FetchAsync(self, url, **kwargs):
+    """Issue a URL Fetch once there is room, retrying transient failures.
+
+    Args:
+      url: The url to fetch.
+      **kwargs: Additional arguments for the ndb context urlfetch().
+
+    Returns:
+      A future for the URL Fetch response.
+    """
+    host = urlparse.urlsplit(url).netloc
+    # the query string may hold credentials
+    loggable_url = url.split('?')[0]
+    self.total += 1
+    yield self._AcquireAsync(host)
+    try:
+      attempt = 0
+      while True:
+        try:
+          response = yield ndb.get_context().urlfetch(url, **kwargs)
+          if (response.status_code < httplib.INTERNAL_SERVER_ERROR or
+              attempt >= self.retries):
+            break
+          reason = 'status code {}'.format(response.status_code)
+        except urlfetch.Error, e:
+          if attempt >= self.retries:
+            self.failed += 1
+            self._ReportProgress()
+            raise
+          reason = e
+        attempt += 1
+        self.retried += 1
+        delay = (settings.FETCH_RETRY_DELAY_SECONDS * 2 ** (attempt - 1) *
+                 random.uniform(0.5, 1.5))
+        shared.w('retrying {} in {:.1f}s after {}'
+                 .format(loggable_url, delay, reason))
+        yield ndb.sleep(delay)
+    finally:
+      self._Release(host)
+    self.completed += 1
+    self._ReportProgress()
+    raise ndb.Return(response)
+
+
 class Fetcher(object):
-  """A wrapper for URL fetch which performs validation and conversion."""
+  """A wrapper for URL fetch which performs validation and conversion.
+
+  The cached resource lookup and the conditional URL Fetch run
+  asynchronously, so many Fetchers created in a row overlap their lookups
+  and fetches.
+
+  Fetches are coalesced. Identical Fetchers in a request share a single
+  URL Fetch call, and a short memcache lease lets Fetchers in other
+  instances wait for the stored result instead of fetching the same url.
+  """
 
   def __init__(self, url, url_auth_suffix='', follow_redirects=False,
-               headers=None):
-    if headers is None:
-      headers = {}
+               headers=None, pool=None, deadline=None, scheduler=None):
     self.url = url
+    self.pool = pool
     self.response = None
-    self.etag, self.response_content = model.GetResource(url)
-    if self.etag:
-      headers['If-None-Match'] = '{}'.format(self.etag)
-    self.rpc = urlfetch.create_rpc()
+    self.etag = None
+    self.response_content = None
+    self._flight = None
+    self._checked = False
     full_url = '{}{}'.format(url, url_auth_suffix)
-    # shared.i('urlfetch.make_fetch_call {} {}'.format(headers, full_url))
-    urlfetch.make_fetch_call(self.rpc, full_url, headers=headers,
-                             follow_redirects=follow_redirects,
-                             validate_certificate=True)
+    self.future = self._FetchAsync(full_url, follow_redirects,
+                                   dict(headers or {}), deadline, scheduler)
+
+  @ndb.tasklet
+  def _FetchAsync(self, full_url, follow_redirects, headers, deadline,
+                  scheduler):
+    if self.pool:
+      resources = yield self.pool.resources
+      self.etag, self.response_content = resources[self.url]
+    else:
+      self.etag, self.response_content = yield model.GetResourceAsync(self.url)
+    flights = _GetFlights()
+    key = (full_url, follow_redirects, tuple(sorted(headers.iteritems())))
+    self._flight = flights.get(key)
+    if not self._flight or self._flight.future.done():
+      self._flight = flights[key] = _Flight(self.url)
+      self._flight.future = _FlyAsync(self._flight, self.etag,
+                                      self.response_content, full_url,
+                                      follow_redirects, headers, deadline,
+                                      scheduler)
+    result = yield self._flight.future
+    raise ndb.Return(result)
 
   def _CheckResponse(self):
     """Verify the current response."""
-    if self.response:
+    if self._checked:
+      return
+    self._checked = True
+    self.response, self.etag, self.response_content = self.future.get_result()
+    if not self.response:
+      shared.i('{} stored by another instance'.format(self.url))
       return
-    self.response = self.rpc.get_result()
     shared.i('{} {}'.format(self.response.status_code, self.url))
     if self.response.content_was_truncated:
+      self._flight.Release(None)
       raise FetchError(self.url, self.response)
     if self.response.status_code == httplib.NOT_MODIFIED:
+      self._flight.Release(self.etag)
       return
     if self.response.status_code == httplib.OK:
       self.response_content = self.response.content
-      self.etag = self.response.headers['ETag']
-      model.PutResource(self.url, self.etag, self.response_content)
+      self.etag = self.response.headers.get('ETag')
+      if not self.etag:
+        # nothing to revalidate against later
+        self._flight.Release(None)
+      elif not self._flight.stored:
+        self._flight.stored = True
+        if self.pool:
+          self.pool.AddResource(self.url, self.etag, self.response_content,
+                                flight=self._flight)
+        else:
+          model.PutResource(self.url, self.etag, self.response_content)
+          self._flight.Release(self.etag)
       return
+    self._flight.Release(self.etag)
     if self.etag and self.response_content:
       shared.w('using existing content etag={}, url={}'
                .format(self.etag, self.url))
@@ -71,3 +561,53 @@ class Fetcher(object):
   @property
   def json_content(self):
     return json.loads(self.content)
+
+
+class FetcherPool(object):
+  """Concurrent Fetchers for many urls with batched resource cache access.
+
+  Cached ETags for all urls are resolved with one batched lookup before the
+  conditional fetches are issued through a FetchScheduler, which bounds
+  their concurrency. New content is written back in one batched put by
+  Flush().
+  """
+
+  def __init__(self, urls, url_auth_suffix='', follow_redirects=False,
+               headers=None, scheduler=None):
+    self.resources = model.GetResourcesAsync(urls)
+    self.scheduler = scheduler or FetchScheduler(self.__class__.__name__)
+    self._pending = []
+    self._flights = []
+    self.fetchers = [Fetcher(url, url_auth_suffix=url_auth_suffix,
+                             follow_redirects=follow_redirects,
+                             headers=headers, pool=self,
+                             scheduler=self.scheduler)
+                     for url in urls]
+
+  def __iter__(self):
+    return iter(self.fetchers)
+
+  def __len__(self):
+    return len(self.fetchers)
+
+  def AddResource(self, url, etag, content, flight=None):
+    self._pending.append((url, etag, content))
+    if flight:
+      self._flights.append((flight, etag))
+
+  def Flush(self):
+    """Persist the new content of all responses checked so far.
+
+    Leases on the fetched urls are released once the content is stored.
+    """
+    if self._pending:
+      model.PutResources(self._pending)
+      self._pending = []
+    etags = {}
+    for flight, etag in self._flights:
+      if flight.leased:
+        flight.leased = False
+        etags[flight.url] = etag
+    self._flights = []
+    if etags:
+      _ReleaseLeases(etags)
@@ -0,0 +1,137 @@
+"""Tests for fetcher.py."""
+
+import httplib
+import unittest
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from . import fetcher
+from . import settings
+
+
+class _Response(object):
+
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+
+class FetchSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_urlfetch_stub()
+    self._retry_delay = settings.FETCH_RETRY_DELAY_SECONDS
+    settings.FETCH_RETRY_DELAY_SECONDS = 0
+    # status codes or exceptions returned by successive fetches
+    self.outcomes = []
+    self.fetched = []
+    context = ndb.tasklets.make_default_context()
+    context.urlfetch = self._FakeUrlFetch
+    ndb.tasklets.set_context(context)
+
+  def tearDown(self):
+    ndb.tasklets.set_context(None)
+    settings.FETCH_RETRY_DELAY_SECONDS = self._retry_delay
+    self.testbed.deactivate()
+
+  @ndb.tasklet
+  def _FakeUrlFetch(self, url, **_):
+    self.fetched.append(url)
+    yield ndb.sleep(0)
+    outcome = self.outcomes.pop(0)
+    if isinstance(outcome, Exception):
+      raise outcome
+    raise ndb.Return(_Response(outcome))
+
+  def testWindow(self):
+    scheduler = fetcher.FetchScheduler(max_in_flight=2, max_per_host=1)
+    first = scheduler._AcquireAsync('a')
+    second = scheduler._AcquireAsync('a')
+    third = scheduler._AcquireAsync('b')
+    fourth = scheduler._AcquireAsync('c')
+    self.assertTrue(first.done())
+    self.assertFalse(second.done())
+    self.assertTrue(third.done())
+    self.assertFalse(fourth.done())
+    scheduler._Release('a')
+    self.assertTrue(second.done())
+    self.assertFalse(fourth.done())
+    scheduler._Release('b')
+    self.assertTrue(fourth.done())
+
+  def testBusyHostDoesNotHoldUpOthers(self):
+    scheduler = fetcher.FetchScheduler(max_in_flight=3, max_per_host=1)
+    scheduler._AcquireAsync('a')
+    blocked = scheduler._AcquireAsync('a')
+    other = scheduler._AcquireAsync('b')
+    self.assertFalse(blocked.done())
+    self.assertTrue(other.done())
+    scheduler._Release('b')
+    self.assertFalse(blocked.done())
+    scheduler._Release('a')
+    self.assertTrue(blocked.done())
+
+  def testFetch(self):
+    self.outcomes = [httplib.OK]
+    scheduler = fetcher.FetchScheduler()
+    response = scheduler.FetchAsync('http://a/1').get_result()
+    self.assertEqual(httplib.OK, response.status_code)
+    self.assertEqual((1, 1, 0, 0), (scheduler.total, scheduler.completed,
+                                    scheduler.failed, scheduler.retried))
+    self.assertEqual(0, scheduler._in_flight)
+
+  def testRetryServerError(self):
+    self.outcomes = [httplib.INTERNAL_SERVER_ERROR, urlfetch.Error(),
+                     httplib.OK]
+    scheduler = fetcher.FetchScheduler(retries=2)
+    response = scheduler.FetchAsync('http://a/1').get_result()
+    self.assertEqual(httplib.OK, response.status_code)
+    self.assertEqual(['http://a/1'] * 3, self.fetched)
+    self.assertEqual(2, scheduler.retried)
+    self.assertEqual(1, scheduler.completed)
+
+  def testServerErrorAfterRetries(self):
+    self.outcomes = [httplib.SERVICE_UNAVAILABLE] * 2
+    scheduler = fetcher.FetchScheduler(retries=1)
+    response = scheduler.FetchAsync('http://a/1').get_result()
+    self.assertEqual(httplib.SERVICE_UNAVAILABLE, response.status_code)
+    self.assertEqual(1, scheduler.completed)
+
+  def testErrorAfterRetries(self):
+    self.outcomes = [urlfetch.Error(), urlfetch.Error()]
+    scheduler = fetcher.FetchScheduler(retries=1)
+    future = scheduler.FetchAsync('http://a/1')
+    self.assertRaises(urlfetch.Error, future.get_result)
+    self.assertEqual((0, 1), (scheduler.completed, scheduler.failed))
+    self.assertEqual(0, scheduler._in_flight)
+
+  def testClientErrorIsNotRetried(self):
+    self.outcomes = [httplib.NOT_FOUND]
+    scheduler = fetcher.FetchScheduler()
+    response = scheduler.FetchAsync('http://a/1').get_result()
+    self.assertEqual(httplib.NOT_FOUND, response.status_code)
+    self.assertEqual(0, scheduler.retried)
+
+  def testConcurrencyIsBounded(self):
+    self.outcomes = [httplib.OK] * 5
+    scheduler = fetcher.FetchScheduler(max_in_flight=2)
+    peak = []
+    urlfetch_async = ndb.get_context().urlfetch
+
+    @ndb.tasklet
+    def _Tracking(url, **kwargs):
+      peak.append(scheduler._in_flight)
+      response = yield urlfetch_async(url, **kwargs)
+      raise ndb.Return(response)
+
+    ndb.get_context().urlfetch = _Tracking
+    futures = [scheduler.FetchAsync('http://a/{}'.format(i))
+               for i in range(5)]
+    ndb.Future.wait_all(futures)
+    self.assertEqual(5, scheduler.completed)
+    self.assertEqual(2, max(peak))
@@ -7,6 +7,7 @@ from mimic.__mimic import common
 from google.appengine.api import taskqueue
 from google.appengine.datastore.datastore_query import Cursor
 
+from . import cow_tree
 from . import model
 from . import secret
 from . import settings
@@ -16,9 +17,13 @@ from . import shared
 # number of entities to fix at a time
 _CURSOR_PAGE_SIZE = 200
 
+# number of resources to fix at a time; resources may be up to 1MB each
+_RESOURCE_CURSOR_PAGE_SIZE = 20
+
 
 def Begin():
   taskqueue.add(queue_name='fixit', url='/playground/fix/project')
+  taskqueue.add(queue_name='fixit', url='/playground/fix/resource')
 
 
 def FixProject(project):
@@ -32,9 +37,26 @@ def FixProject(project):
   if project._properties.has_key('end_user_url'):
     project._properties.pop('end_user_url')
     dirty = True
+  if project.expiration_seconds and not project.expires:
+    # index the project for the expiration sweeper
+    model.BackfillProjectExpiration(project)
+    dirty = True
   if dirty:
     project.put()
     shared.w('fixed {}'.format(project.key))
+  if not project.blob_files:
+    cow_tree.MigrateLegacyFiles(project)
+
+
+def FixResource(resource):
+  """Fix or update a resource entity."""
+  if resource.last_accessed and resource.size is not None:
+    return
+  # make the resource visible to the eviction sweeper
+  resource.last_accessed = resource.last_accessed or resource.last_modified
+  resource.size = model.GetResourceSize(resource)
+  resource.put()
+  shared.w('fixed {}'.format(resource.key))
 
 
 class ProjectHandler(webapp2.RequestHandler):
@@ -58,6 +80,25 @@ class ProjectHandler(webapp2.RequestHandler):
                'ALTHOUGH OTHER TASKS MAY STILL BE EXECUTING')
 
 
+class ResourceHandler(webapp2.RequestHandler):
+
+  def post(self):  # pylint:disable-msg=invalid-name,missing-docstring
+    assert self.request.environ[common.HTTP_X_APPENGINE_QUEUENAME]
+    query = model.Resource.query(namespace=settings.PLAYGROUND_NAMESPACE)
+    cursor = self.request.get('cursor', None)
+    if cursor:
+      cursor = Cursor(urlsafe=cursor)
+    resources, next_cursor, more = query.fetch_page(_RESOURCE_CURSOR_PAGE_SIZE,
+                                                    start_cursor=cursor)
+    if more and next_cursor:
+      taskqueue.add(queue_name='fixit',
+                    url='/playground/fix/resource',
+                    params={'cursor': next_cursor.urlsafe()})
+    for resource in resources:
+      FixResource(resource)
+
+
 app = webapp2.WSGIApplication([
     ('/playground/fix/project', ProjectHandler),
+    ('/playground/fix/resource', ResourceHandler),
 ], debug=True)
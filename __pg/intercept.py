@@ -1,13 +1,20 @@
 """Module containing the mimic WSGI intercept apps."""
 
 from mimic import mimic_wsgi
+from mimic.__mimic import common
 
+from . import control
 from . import middleware
 from . import settings
 from . import wsgi_config
 
 
 control_app = mimic_wsgi.Mimic
+control_app = middleware.DirectoryListingFilter(
+    control_app, '{}/dir'.format(common.CONTROL_PREFIX))
+control_app = middleware.ConditionalGetFilter(
+    control_app, ['{}/file'.format(common.CONTROL_PREFIX),
+                  '{}/dir'.format(common.CONTROL_PREFIX)])
 control_app = middleware.MimicControlAccessFilter(control_app)
 control_app = middleware.Session(control_app, wsgi_config.WSGI_CONFIG)
 control_app = middleware.AccessKeyHttpHeaderFilter(control_app)
@@ -15,6 +22,19 @@ control_app = middleware.Redirector(control_app)
 control_app = middleware.ProjectFilter(control_app)
 control_app = middleware.ErrorHandler(control_app, debug=settings.DEBUG)
 
+playground_control_app = control.app
+playground_control_app = middleware.ConditionalGetFilter(
+    playground_control_app, [control.STAT_PATH])
+playground_control_app = middleware.MimicControlAccessFilter(
+    playground_control_app)
+playground_control_app = middleware.Session(playground_control_app,
+                                            wsgi_config.WSGI_CONFIG)
+playground_control_app = middleware.AccessKeyHttpHeaderFilter(
+    playground_control_app)
+playground_control_app = middleware.ProjectFilter(playground_control_app)
+playground_control_app = middleware.ErrorHandler(playground_control_app,
+                                                 debug=settings.DEBUG)
+
 user_app = mimic_wsgi.Mimic
 user_app = middleware.MimicControlAccessFilter(user_app)
 user_app = middleware.AccessKeyCookieFilter(user_app)
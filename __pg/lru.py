@@ -0,0 +1,78 @@
+"""A bounded, instance-local least recently used cache."""
+
+import collections
+import threading
+import time
+
+
+class LruCache(object):
+  """An LRU cache with optional per-entry time to live.
+
+  The cache is bounded by the sum of sizeof(value) over all entries, which
+  defaults to bounding the number of entries.
+  """
+
+  def __init__(self, max_size, ttl_seconds=None, sizeof=None):
+    self._max_size = max_size
+    self._ttl_seconds = ttl_seconds
+    self._sizeof = sizeof or (lambda value: 1)
+    self._entries = collections.OrderedDict()
+    self._size = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _Pop(self, key):
+    _, _, size = self._entries.pop(key)
+    self._size -= size
+
+  def Get(self, key):
+    """Returns the cached value or None."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry and self._ttl_seconds and entry[1] < time.time():
+        self._Pop(key)
+        entry = None
+      if not entry:
+        self.misses += 1
+        return None
+      self.hits += 1
+      # move to most recently used position
+      del self._entries[key]
+      self._entries[key] = entry
+      return entry[0]
+
+  def Put(self, key, value):
+    """Add or replace a value, evicting least recently used entries."""
+    size = self._sizeof(value)
+    with self._lock:
+      if key in self._entries:
+        self._Pop(key)
+      if size > self._max_size:
+        return
+      expires = self._ttl_seconds and time.time() + self._ttl_seconds
+      self._entries[key] = (value, expires, size)
+      self._size += size
+      while self._size > self._max_size:
+        self._Pop(next(iter(self._entries)))
+
+  def Pop(self, key):
+    with self._lock:
+      if key in self._entries:
+        self._Pop(key)
+
+  def Clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+
+  def Stats(self):
+    return {
+        'entries': len(self._entries),
+        'size': self._size,
+        'hits': self.hits,
+        'misses': self.misses,
+    }
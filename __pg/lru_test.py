@@ -0,0 +1,87 @@
+"""Tests for lru.py."""
+
+import time
+import unittest
+
+from . import lru
+
+
+class LruCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.now = 1000.0
+    self._time = time.time
+    time.time = lambda: self.now
+
+  def tearDown(self):
+    time.time = self._time
+
+  def testGetMissing(self):
+    cache = lru.LruCache(2)
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual(1, cache.Stats()['misses'])
+
+  def testPutAndGet(self):
+    cache = lru.LruCache(2)
+    cache.Put('a', 1)
+    self.assertEqual(1, cache.Get('a'))
+    self.assertEqual({'entries': 1, 'size': 1, 'hits': 1, 'misses': 0},
+                     cache.Stats())
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = lru.LruCache(2)
+    cache.Put('a', 1)
+    cache.Put('b', 2)
+    # 'a' becomes the most recently used entry
+    cache.Get('a')
+    cache.Put('c', 3)
+    self.assertEqual(1, cache.Get('a'))
+    self.assertIsNone(cache.Get('b'))
+    self.assertEqual(3, cache.Get('c'))
+    self.assertEqual(2, len(cache))
+
+  def testReplaceKeepsSize(self):
+    cache = lru.LruCache(2)
+    cache.Put('a', 1)
+    cache.Put('a', 2)
+    self.assertEqual(2, cache.Get('a'))
+    self.assertEqual(1, cache.Stats()['size'])
+
+  def testSizeof(self):
+    cache = lru.LruCache(10, sizeof=len)
+    cache.Put('a', 'x' * 6)
+    cache.Put('b', 'x' * 4)
+    self.assertEqual(10, cache.Stats()['size'])
+    cache.Put('c', 'x')
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual(5, cache.Stats()['size'])
+
+  def testValueLargerThanCacheIsNotStored(self):
+    cache = lru.LruCache(4, sizeof=len)
+    cache.Put('a', 'x' * 2)
+    cache.Put('a', 'x' * 5)
+    # the oversized value also replaces the previous one
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual(0, cache.Stats()['size'])
+
+  def testTtl(self):
+    cache = lru.LruCache(2, ttl_seconds=10)
+    cache.Put('a', 1)
+    self.now += 10
+    self.assertEqual(1, cache.Get('a'))
+    self.now += 1
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual(0, len(cache))
+
+  def testPopAndClear(self):
+    cache = lru.LruCache(3)
+    cache.Put('a', 1)
+    cache.Put('b', 2)
+    cache.Pop('a')
+    cache.Pop('missing')
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual(1, cache.Stats()['size'])
+    cache.Clear()
+    self.assertEqual(0, len(cache))
+    self.assertEqual(0, cache.Stats()['size'])
+
@@ -1,6 +1,8 @@
 """Playground middleware."""
 
+import hashlib
 import httplib
+import json
 import logging
 import sys
 
@@ -10,6 +12,7 @@ from webapp2_extras import security
 from webapp2_extras import sessions
 
 from . import appids
+from . import control
 from . import error
 from error import Abort
 from mimic.__mimic import common
@@ -31,6 +34,11 @@ _XSRF_TOKEN_COOKIE = 'XSRF-TOKEN'
 _XSRF_TOKEN_HEADER = 'HTTP_X_XSRF_TOKEN'
 
 
+# mimic control paths which operate on the project tree
+_CONTROL_PATHS_REQUIRING_TREE = frozenset(
+    common.CONTROL_PATHS_REQUIRING_TREE) | control.CONTROL_PATHS
+
+
 def MakeCookieHeader(name, value, cookie_args=None):
   items = ['{}={}'.format(name, value)]
   items.append('Path=/')
@@ -125,7 +133,8 @@ class Session(object):
 
   Adds the following keys to the environ:
   - environ['playground.session'] contains a webapp2 session
-  - environ['playground.user']    contains the current user entity
+  - environ['playground.user']    contains the current, possibly not yet
+                                  stored, user entity
   """
 
   def __init__(self, app, config):
@@ -170,11 +179,10 @@ class Session(object):
           self.MakeXsrfCookieHeader(session),
       ])
 
-    # 2. ensure we have an user entity
+    # 2. ensure we have an user entity, stored lazily by the first write
     user_key = GetUserKey(session)
     assert user_key
-    # TODO: avoid creating a datastore entity on every anonymous request
-    environ['playground.user'] = model.GetOrCreateUser(user_key)
+    environ['playground.user'] = model.GetOrMakeUser(user_key)
 
     # 3. perform CSRF checks
     if not shared.IsHttpReadMethod(environ):
@@ -197,7 +205,7 @@ class ProjectFilter(object):
   def __call__(self, environ, start_response):
     project_id = mimic.GetProjectId(environ, False)
     if project_id and shared.ThisIsPlaygroundApp():
-      project = model.GetProject(project_id)
+      project = model.GetCachedProject(project_id)
       if self._assert_project_existence:
         if not project:
           Abort(httplib.NOT_FOUND, 'project_id {} not found'.format(project_id))
@@ -274,7 +282,7 @@ class MimicControlAccessFilter(object):
     self.exc_info = None
 
   def _AssertCollaboratingAppIdAccessCheck(self, environ):
-    if environ['PATH_INFO'] in common.CONTROL_PATHS_REQUIRING_TREE:
+    if environ['PATH_INFO'] in _CONTROL_PATHS_REQUIRING_TREE:
       if not shared.ThisIsPlaygroundApp():
         Abort(httplib.FORBIDDEN,
               'playground service is not available in this app id')
@@ -287,7 +295,7 @@ class MimicControlAccessFilter(object):
     if appids.TWO_COLLABORATING_APP_IDS:
       self._AssertCollaboratingAppIdAccessCheck(environ)
 
-    if environ['PATH_INFO'] in common.CONTROL_PATHS_REQUIRING_TREE:
+    if environ['PATH_INFO'] in _CONTROL_PATHS_REQUIRING_TREE:
       if shared.IsHttpReadMethod(environ):
         if not shared.HasProjectReadAccess(environ):
           Abort(httplib.UNAUTHORIZED, 'no project read access to mimic control')
@@ -298,6 +306,128 @@ class MimicControlAccessFilter(object):
     return self.app(environ, start_response)
 
 
+def _BufferResponse(app, environ):
+  """Run a WSGI app to completion.
+
+  Args:
+    app: The WSGI app.
+    environ: The WSGI environ.
+
+  Returns:
+    A (status, headers, exc_info, body) tuple.
+  """
+  response = {'written': []}
+
+  # pylint:disable-msg=invalid-name
+  def buffering_start_response(status, headers, exc_info=None):
+    response['status'] = status
+    response['headers'] = headers
+    response['exc_info'] = exc_info
+    return response['written'].append
+
+  app_iter = app(environ, buffering_start_response)
+  try:
+    body = ''.join(response['written'] + list(app_iter))
+  finally:
+    if hasattr(app_iter, 'close'):
+      app_iter.close()
+  return response['status'], response['headers'], response['exc_info'], body
+
+
+def _FilterListing(entries, prefix, depth):
+  """Restrict directory listing entries to a prefix and depth.
+
+  Files nested deeper than depth below the prefix are replaced by a single
+  entry for their enclosing directory, whose path ends with a slash.
+  """
+  listing = []
+  dirs = set()
+  for entry in entries:
+    path = entry['path']
+    if not path.startswith(prefix):
+      continue
+    segments = path[len(prefix):].split('/')
+    if depth is None or len(segments) <= depth:
+      listing.append(entry)
+      continue
+    dirpath = prefix + '/'.join(segments[:depth]) + '/'
+    if dirpath not in dirs:
+      dirs.add(dirpath)
+      listing.append({'path': dirpath})
+  return listing
+
+
+class DirectoryListingFilter(object):
+  """WSGI middleware which adds prefix and depth filtering to listings.
+
+  Applies to JSON directory listings served at the given path when the
+  'prefix' or 'depth' query parameters are present. Other requests, such as
+  full listings requested by the playground UI, pass through unaltered.
+  """
+
+  def __init__(self, app, path):
+    self.app = app
+    self.path = path
+
+  def __call__(self, environ, start_response):
+    if (environ['REQUEST_METHOD'] != 'GET' or
+        environ['PATH_INFO'] != self.path):
+      return self.app(environ, start_response)
+    request = webapp2.Request(environ)
+    prefix = request.get('prefix')
+    depth = request.get('depth')
+    if not prefix and not depth:
+      return self.app(environ, start_response)
+    try:
+      depth = int(depth) if depth else None
+    except ValueError:
+      Abort(httplib.BAD_REQUEST, 'depth must be an integer')
+
+    status, headers, exc_info, body = _BufferResponse(self.app, environ)
+    if not status.startswith('200 '):
+      start_response(status, headers, exc_info)
+      return [body]
+    body = json.dumps(_FilterListing(json.loads(body), prefix, depth))
+    headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+    headers.append(('Content-Length', str(len(body))))
+    start_response(status, headers)
+    return [body]
+
+
+class ConditionalGetFilter(object):
+  """WSGI middleware which adds ETag validation to selected GET responses.
+
+  Successful responses for the given paths are buffered and tagged with the
+  SHA-1 of their body. Requests whose If-None-Match header carries the same
+  tag receive '304 Not Modified' without a body.
+  """
+
+  def __init__(self, app, paths):
+    self.app = app
+    self.paths = frozenset(paths)
+
+  def __call__(self, environ, start_response):
+    if (environ['REQUEST_METHOD'] != 'GET' or
+        environ['PATH_INFO'] not in self.paths):
+      return self.app(environ, start_response)
+
+    status, headers, exc_info, body = _BufferResponse(self.app, environ)
+    if not status.startswith('200 '):
+      start_response(status, headers, exc_info)
+      return [body]
+
+    etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+    headers = [(k, v) for k, v in headers if k.lower() != 'etag']
+    headers.append(('ETag', etag))
+    if environ.get('HTTP_IF_NONE_MATCH') == etag:
+      headers = [(k, v) for k, v in headers
+                 if k.lower() not in ('content-length', 'content-type')]
+      start_response('304 Not Modified', headers)
+      return ['']
+    start_response(status, headers)
+    return [body]
+
+
 class ErrorHandler(object):
   """WSGI middleware which adds PlaygroundError handling."""
 
@@ -0,0 +1,50 @@
+"""Tests for middleware.py."""
+
+import unittest
+
+from . import middleware
+
+
+_ENTRIES = [
+    {'path': 'app.yaml', 'size': 1},
+    {'path': 'static/css/main.css', 'size': 2},
+    {'path': 'static/index.html', 'size': 3},
+    {'path': 'static/js/app.js', 'size': 4},
+    {'path': 'staticfile.txt', 'size': 5},
+]
+
+
+def _Paths(listing):
+  return [entry['path'] for entry in listing]
+
+
+class FilterListingTest(unittest.TestCase):
+
+  def testNoFilter(self):
+    self.assertEqual(_ENTRIES, middleware._FilterListing(_ENTRIES, '', None))
+
+  def testPrefix(self):
+    listing = middleware._FilterListing(_ENTRIES, 'static/', None)
+    self.assertEqual(['static/css/main.css', 'static/index.html',
+                      'static/js/app.js'], _Paths(listing))
+    # file entries are passed through unaltered
+    self.assertEqual(_ENTRIES[2], listing[1])
+
+  def testDepth(self):
+    listing = middleware._FilterListing(_ENTRIES, '', 1)
+    self.assertEqual(['app.yaml', 'static/', 'staticfile.txt'],
+                     _Paths(listing))
+    self.assertEqual({'path': 'static/'}, listing[1])
+
+  def testPrefixAndDepth(self):
+    listing = middleware._FilterListing(_ENTRIES, 'static/', 1)
+    self.assertEqual(['static/css/', 'static/index.html', 'static/js/'],
+                     _Paths(listing))
+
+  def testDeeperDepth(self):
+    listing = middleware._FilterListing(_ENTRIES, '', 2)
+    self.assertEqual(['app.yaml', 'static/css/', 'static/index.html',
+                      'static/js/', 'staticfile.txt'], _Paths(listing))
+
+  def testNoMatch(self):
+    self.assertEqual([], middleware._FilterListing(_ENTRIES, 'lib/', None))
@@ -1,12 +1,14 @@
 """Module containing the datastore mode and associated functions."""
 
-import os
 import random
+import re
 import time
+import zlib
 
 from mimic.__mimic import common
 
 import datetime
+from . import lru
 from . import secret
 from . import settings
 from . import shared
@@ -17,6 +19,21 @@ from google.appengine.api.datastore_types import _MAX_RAW_PROPERTY_BYTES
 from google.appengine.ext import ndb
 
 
+# memcache key prefix for small Resource contents
+_RESOURCE_MEMCACHE_PREFIX = 'resource_'
+
+# Resource.encoding of zlib compressed content
+_RESOURCE_ENCODING_ZLIB = 'zlib'
+
+# instance-local cache of (version, Project entity), keyed by project id
+_project_cache = lru.LruCache(settings.PROJECT_CACHE_SIZE,
+                              ttl_seconds=settings.PROJECT_CACHE_TTL_SECONDS)
+
+# memcache key prefix for a random version of each project, replaced on every
+# put, against which instance-local cached projects are validated
+_PROJECT_VERSION_MEMCACHE_PREFIX = 'project_version_'
+
+
 class Global(ndb.Model):
   """A Model used to store the root entity for global configuration data.
 
@@ -55,6 +72,41 @@ class Project(ndb.Model):
   access_key = ndb.StringProperty(required=True, indexed=False)
   expiration_seconds = ndb.IntegerProperty(required=True, indexed=False)
   hide_template = ndb.BooleanProperty(required=False)
+  # high-water mark of the last modification of any project file
+  content_updated = ndb.DateTimeProperty(required=False, indexed=False)
+  # project files are held in a blob tree, not the legacy datastore tree
+  blob_files = ndb.BooleanProperty(required=False, indexed=False)
+  # immutable snapshot tree which file reads fall through to
+  base_snapshot = ndb.StringProperty(required=False, indexed=False)
+  # template projects only: latest snapshot of the template files
+  current_snapshot = ndb.StringProperty(required=False, indexed=False)
+  # template projects only: snapshot in which the template is being rebuilt
+  staging_snapshot = ndb.StringProperty(required=False, indexed=False)
+  # queried by the expiration sweeper, see expiration.py
+  expires = ndb.DateTimeProperty(required=False)
+  expiration_shard = ndb.IntegerProperty(required=False)
+  # set by BackfillProjectExpiration() for the duration of a single put
+  _expires_backfilled = False
+
+  def _pre_put_hook(self):
+    if not self.expiration_seconds:
+      self.expires = None
+      return
+    if self._expires_backfilled:
+      self._expires_backfilled = False
+    else:
+      # every put counts as a modification, see GetProjectLastModified()
+      self.expires = (datetime.datetime.now() +
+                      datetime.timedelta(0, self.expiration_seconds))
+    if self.expiration_shard is None:
+      self.expiration_shard = random.randrange(settings.EXPIRATION_SHARDS)
+
+  def _post_put_hook(self, future):
+    _InvalidateCachedProject(self.key.id())
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    _InvalidateCachedProject(key.id())
 
 
 class User(ndb.Model):
@@ -68,11 +120,24 @@ class User(ndb.Model):
 class Resource(ndb.Model):
   """A cache for web content.
 
-  The url is used as the entity key.
+  The url is used as the entity key. Stored content is compressed if that
+  makes it smaller, as recorded by encoding. Stored content larger than
+  _MAX_RAW_PROPERTY_BYTES is split into num_chunks ResourceChunk children
+  with ids 1..num_chunks.
+
+  last_accessed is advanced at most once per
+  RESOURCE_ACCESS_RESOLUTION_SECONDS and orders resources for eviction.
   """
   etag = ndb.StringProperty(required=True, indexed=False)
   content = ndb.BlobProperty(required=False)
+  num_chunks = ndb.IntegerProperty(required=False, indexed=False)
+  # None for raw content
+  encoding = ndb.StringProperty(required=False, indexed=False,
+                                choices=[_RESOURCE_ENCODING_ZLIB])
   last_modified = ndb.DateTimeProperty(auto_now=True)
+  last_accessed = ndb.DateTimeProperty(required=False)
+  # stored bytes, including chunks
+  size = ndb.IntegerProperty(required=False, indexed=False)
 
 
 class ResourceChunk(ndb.Model):
@@ -80,6 +145,41 @@ class ResourceChunk(ndb.Model):
   content = ndb.BlobProperty(required=True)
 
 
+class Blob(ndb.Model):
+  """Content addressed file contents shared by project trees.
+
+  The SHA-1 hex digest of the content is used as the entity key id. The
+  content itself is stored in BlobChunk child entities, which are written
+  once and never updated.
+  """
+  size = ndb.IntegerProperty(required=True, indexed=False)
+  refcount = ndb.IntegerProperty(required=True, indexed=False)
+
+
+class BlobChunk(ndb.Model):
+  """A model for storing up to _MAX_RAW_PROPERTY_BYTES of blob content."""
+  content = ndb.BlobProperty(required=True)
+
+
+class TreeFile(ndb.Model):
+  """A reference from a tree path to a Blob.
+
+  The path is used as the entity key id. The parent key identifies the tree.
+  """
+  blob = ndb.StringProperty(required=True, indexed=False)
+  size = ndb.IntegerProperty(required=True, indexed=False)
+  updated = ndb.DateTimeProperty(required=True, auto_now=True, indexed=False)
+
+
+class SnapshotReferences(ndb.Model):
+  """The number of projects which read from a snapshot tree.
+
+  The snapshot tree namespace is used as the entity key id. The count is
+  updated in the same transactions which change Project.base_snapshot.
+  """
+  count = ndb.IntegerProperty(required=True, indexed=False)
+
+
 class RepoCollection(ndb.Model):
   """A Model to represent a collection of code repositories.
 
@@ -113,41 +213,277 @@ class Repo(ndb.Model):
   is_read_only = ndb.BooleanProperty(required=False)
   hide_template = ndb.BooleanProperty(required=False)
   download_filename = ndb.StringProperty(required=False)
+  # git SHA of the root tree and blob SHA of each file, by path, as of the
+  # last population; used to refresh only the files which changed
+  tree_sha = ndb.StringProperty(required=False, indexed=False)
+  blob_shas = ndb.JsonProperty(required=False, compressed=True)
+  # blob SHA of each file in the template project's staging snapshot, by
+  # path, kept while population is deferred so that it resumes there
+  staging_blob_shas = ndb.JsonProperty(required=False, compressed=True)
+  # url of the repo collection which discovered this repo, if any
+  collection_url = ndb.StringProperty(required=False, indexed=False)
+
+
+def _ResourceKey(url):
+  return ndb.Key(Resource, url, namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def _ResourceMemcacheKey(url):
+  return '{}{}'.format(_RESOURCE_MEMCACHE_PREFIX, url)
+
+
+def _NeedsAccessStamp(last_accessed, now):
+  resolution = datetime.timedelta(
+      seconds=settings.RESOURCE_ACCESS_RESOLUTION_SECONDS)
+  return not last_accessed or now - last_accessed >= resolution
+
+
+@ndb.transactional_tasklet
+def _StampResourceAccessAsync(key, now):
+  resource = yield key.get_async()
+  if resource:
+    resource.last_accessed = now
+    yield resource.put_async()
+
+
+@ndb.tasklet
+def GetResourceAsync(url):
+  """Retrieve a previously stored resource.
+
+  Small resources are served from memcache. Otherwise the resource and its
+  chunks are read by key. Either way the access is recorded for eviction.
+
+  Args:
+    url: The resource url.
+
+  Returns:
+    A future for an (etag, content) tuple, which is (None, None) if no
+    resource is stored.
+  """
+  context = ndb.get_context()
+  now = datetime.datetime.now()
+  key = _ResourceKey(url)
+  cached = yield context.memcache_get(_ResourceMemcacheKey(url),
+                                      namespace=settings.PLAYGROUND_NAMESPACE)
+  if cached:
+    etag, content, last_accessed = cached
+    if _NeedsAccessStamp(last_accessed, now):
+      yield _StampResourceAccessAsync(key, now)
+      yield context.memcache_set(_ResourceMemcacheKey(url),
+                                 (etag, content, now),
+                                 namespace=settings.PLAYGROUND_NAMESPACE)
+    raise ndb.Return((etag, content))
+  resource = yield key.get_async()
+  if not resource:
+    raise ndb.Return((None, None))
+  if _NeedsAccessStamp(resource.last_accessed, now):
+    yield _StampResourceAccessAsync(key, now)
+    resource.last_accessed = now
+  if resource.content is not None:
+    content = resource.content
+  elif resource.num_chunks:
+    keys = [ndb.Key(ResourceChunk, i + 1, parent=key)
+            for i in range(resource.num_chunks)]
+    chunks = yield ndb.get_multi_async(keys)
+    if None in chunks:
+      raise ndb.Return((None, None))
+    content = ''.join([c.content for c in chunks])
+  else:
+    # resources stored before num_chunks was maintained
+    chunks = yield ResourceChunk.query(ancestor=key).fetch_async()
+    content = ''.join([c.content for c in chunks])
+  if resource.encoding == _RESOURCE_ENCODING_ZLIB:
+    content = zlib.decompress(content)
+  if len(content) <= settings.RESOURCE_MEMCACHE_MAX_BYTES:
+    yield context.memcache_set(_ResourceMemcacheKey(url),
+                               (resource.etag, content, resource.last_accessed),
+                               namespace=settings.PLAYGROUND_NAMESPACE)
+  raise ndb.Return((resource.etag, content))
+
+
+@ndb.tasklet
+def GetResourcesAsync(urls):
+  """Retrieve many previously stored resources.
+
+  The individual lookups are autobatched by ndb, so each stage costs one
+  memcache and one datastore batch call for all urls together.
+
+  Args:
+    urls: The resource urls.
+
+  Returns:
+    A future for a dict mapping each url to an (etag, content) tuple.
+  """
+  resources = yield [GetResourceAsync(url) for url in urls]
+  raise ndb.Return(dict(zip(urls, resources)))
 
 
 def GetResource(url):
   """Retrieve a previously stored resource."""
-  key = ndb.Key(Resource, url, namespace=settings.PLAYGROUND_NAMESPACE)
-  query = ndb.Query(ancestor=key)
-  results = query.fetch()
-  if not results:
-    return None, None
-  resource = results[0]
-  if resource.content is not None:
-    return resource.etag, resource.content
-  content = ''
-  for resource_chunk in results[1:]:
-    content += resource_chunk.content
-  return resource.etag, content
+  return GetResourceAsync(url).get_result()
+
+
+def PutResources(resources):
+  """Persist many resources with batched datastore and memcache calls.
+
+  Args:
+    resources: A list of (url, etag, content) tuples.
+  """
+  now = datetime.datetime.now()
+  keys = [_ResourceKey(url) for url, _, _ in resources]
+  entities = []
+  stale_chunk_keys = []
+  cached = {}
+  uncached = []
+  previous_resources = ndb.get_multi(keys)
+  # resources stored before num_chunks was maintained; queried concurrently
+  legacy_chunk_keys = dict(
+      (key, ResourceChunk.query(ancestor=key).fetch_async(keys_only=True))
+      for key, previous in zip(keys, previous_resources)
+      if previous and previous.num_chunks is None)
+  for key, previous, (url, etag, content) in zip(keys, previous_resources,
+                                                 resources):
+    if not previous:
+      old_chunk_ids = []
+    elif key in legacy_chunk_keys:
+      old_chunk_ids = [k.id() for k in legacy_chunk_keys[key].get_result()]
+    else:
+      old_chunk_ids = range(1, previous.num_chunks + 1)
+    resource = Resource(key=key, etag=etag, last_accessed=now)
+    entities.append(resource)
+    stored = zlib.compress(content)
+    if len(stored) < len(content):
+      resource.encoding = _RESOURCE_ENCODING_ZLIB
+    else:
+      stored = content
+    resource.size = len(stored)
+    if len(stored) <= _MAX_RAW_PROPERTY_BYTES:
+      resource.content = stored
+      resource.num_chunks = 0
+    else:
+      chunks = [stored[i:i + _MAX_RAW_PROPERTY_BYTES]
+                for i in range(0, len(stored), _MAX_RAW_PROPERTY_BYTES)]
+      resource.num_chunks = len(chunks)
+      entities.extend([ResourceChunk(id=i + 1, parent=key, content=chunks[i])
+                       for i in range(0, len(chunks))])
+    stale_chunk_keys.extend([ndb.Key(ResourceChunk, i, parent=key)
+                             for i in old_chunk_ids
+                             if i > resource.num_chunks])
+    if len(content) <= settings.RESOURCE_MEMCACHE_MAX_BYTES:
+      cached[_ResourceMemcacheKey(url)] = (etag, content, now)
+    else:
+      uncached.append(_ResourceMemcacheKey(url))
+  ndb.put_multi(entities)
+  ndb.delete_multi(stale_chunk_keys)
+  memcache.set_multi(cached, namespace=settings.PLAYGROUND_NAMESPACE)
+  memcache.delete_multi(uncached, namespace=settings.PLAYGROUND_NAMESPACE)
 
 
 def PutResource(url, etag, content):
   """Persist a resource."""
-  key = ndb.Key(Resource, url, namespace=settings.PLAYGROUND_NAMESPACE)
-  keys = ndb.Query(ancestor=key).fetch(keys_only=True)
+  PutResources([(url, etag, content)])
+
+
+def _GetResourceChunkKeys(resource):
+  if resource.num_chunks is not None:
+    return [ndb.Key(ResourceChunk, i + 1, parent=resource.key)
+            for i in range(resource.num_chunks)]
+  # resources stored before num_chunks was maintained
+  return ResourceChunk.query(ancestor=resource.key).fetch(keys_only=True)
+
+
+def GetResourceSize(resource):
+  """Returns the stored bytes of a resource, including its chunks."""
+  if resource.size is not None:
+    return resource.size
+  if resource.content is not None:
+    return len(resource.content)
+  chunks = ndb.get_multi(_GetResourceChunkKeys(resource))
+  return sum(len(c.content) for c in chunks if c)
+
+
+def DeleteResources(resources):
+  """Delete resources along with their chunks and memcache entries.
+
+  Args:
+    resources: A list of Resource entities.
+
+  Returns:
+    The number of stored bytes reclaimed.
+  """
+  reclaimed = 0
+  keys = []
+  for resource in resources:
+    reclaimed += GetResourceSize(resource)
+    keys.append(resource.key)
+    keys.extend(_GetResourceChunkKeys(resource))
   ndb.delete_multi(keys)
-  resource = Resource(id=url, etag=etag,
-                      namespace=settings.PLAYGROUND_NAMESPACE)
-  if len(content) <= _MAX_RAW_PROPERTY_BYTES:
-    resource.content = content
-    resource.put()
-    return
-  chunks = [content[i:i + _MAX_RAW_PROPERTY_BYTES]
-            for i in range(0, len(content), _MAX_RAW_PROPERTY_BYTES)]
-  entities = [ResourceChunk(id=i + 1, parent=resource.key, content=chunks[i])
-              for i in range(0, len(chunks))]
-  entities.append(resource)
-  ndb.put_multi(entities)
+  memcache.delete_multi([_ResourceMemcacheKey(r.key.id()) for r in resources],
+                        namespace=settings.PLAYGROUND_NAMESPACE)
+  return reclaimed
+
+
+def _BlobKey(blob):
+  return ndb.Key(Blob, blob, namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def _BlobChunkKeys(blob, size):
+  num_chunks = max(1, -(-size // _MAX_RAW_PROPERTY_BYTES))
+  blob_key = _BlobKey(blob)
+  return [ndb.Key(BlobChunk, i + 1, parent=blob_key)
+          for i in range(0, num_chunks)]
+
+
+def GetBlobContents(blob, size):
+  """Retrieve the content of a blob with a single batch get."""
+  chunks = ndb.get_multi(_BlobChunkKeys(blob, size))
+  if None in chunks:
+    shared.e('missing content for blob {}'.format(blob))
+  return ''.join([chunk.content for chunk in chunks])
+
+
+def ApplyBlobReferences(deltas, contents):
+  """Add or remove blob references within the current transaction.
+
+  Blobs are created when first referenced and deleted along with their content
+  when the last reference goes away. Callers update the referencing entities in
+  the same cross-group transaction.
+
+  Args:
+    deltas: A dict of blob id to reference count delta.
+    contents: A dict of blob id to content, for blobs which may not exist yet.
+  """
+  assert ndb.in_transaction()
+  blobs = [blob for blob, delta in deltas.iteritems() if delta]
+  blob_keys = [_BlobKey(blob) for blob in blobs]
+  to_put = []
+  to_delete = []
+  for blob_key, blob_entity in zip(blob_keys, ndb.get_multi(blob_keys)):
+    blob = blob_key.id()
+    delta = deltas[blob]
+    if blob_entity:
+      blob_entity.refcount += delta
+      if blob_entity.refcount > 0:
+        to_put.append(blob_entity)
+      else:
+        to_delete.append(blob_key)
+        to_delete.extend(_BlobChunkKeys(blob, blob_entity.size))
+      continue
+    if delta <= 0:
+      continue
+    content = contents.get(blob)
+    if content is None:
+      shared.w('ignoring reference to missing blob {}'.format(blob))
+      continue
+    to_put.append(Blob(key=blob_key, size=len(content), refcount=delta))
+    chunk_keys = _BlobChunkKeys(blob, len(content))
+    for i, chunk_key in enumerate(chunk_keys):
+      offset = i * _MAX_RAW_PROPERTY_BYTES
+      to_put.append(BlobChunk(
+          key=chunk_key,
+          content=content[offset:offset + _MAX_RAW_PROPERTY_BYTES]))
+  ndb.put_multi(to_put)
+  ndb.delete_multi(to_delete)
 
 
 def GetOAuth2Credential(key):
@@ -171,7 +507,7 @@ def GetRepo(repo_url):
 def CreateRepoAsync(owner, repo_url, html_url, name, description, show_files,
                     read_only_files, read_only_demo_url, orderby=None,
                     download_filename=None, hide_template=False,
-                    is_read_only=False):
+                    is_read_only=False, collection_url=None):
   """Asynchronously create a repo."""
   repo = GetRepo(repo_url)
   if not repo:
@@ -187,7 +523,8 @@ def CreateRepoAsync(owner, repo_url, html_url, name, description, show_files,
                 namespace=settings.PLAYGROUND_NAMESPACE,
                 download_filename=download_filename,
                 hide_template=hide_template,
-                is_read_only=is_read_only)
+                is_read_only=is_read_only,
+                collection_url=collection_url)
   elif repo.in_progress_task_name:
     shared.w('ignoring recreation of {} which is already executing in task {}'
              .format(repo_url, repo.in_progress_task_name))
@@ -198,9 +535,8 @@ def CreateRepoAsync(owner, repo_url, html_url, name, description, show_files,
                        transactional=True)
   shared.i('task {} added to populate repo {}'.format(task.name, repo_url))
   repo.in_progress_task_name = task.name
-  if repo.project:
-    SetProjectOwningTask(repo.project, task.name)
-  else:
+  # existing template projects stay available while they are rebuilt
+  if not repo.project:
     project = CreateProject(owner=owner,
                             template_url=repo_url,
                             html_url=html_url,
@@ -216,18 +552,73 @@ def CreateRepoAsync(owner, repo_url, html_url, name, description, show_files,
                             is_read_only=is_read_only,
                             hide_template=hide_template)
     repo.project = project.key
+    # the new project's tree is empty
+    repo.tree_sha = None
+    repo.blob_shas = None
   repo.put()
   return repo
 
 
+@ndb.transactional(xg=True)
+def DeferRepoPopulation(repo_url, countdown, staging_blob_shas=None):
+  """Replace the current repo population task with a later one.
+
+  Args:
+    repo_url: The repo url.
+    countdown: Seconds until the new task runs.
+    staging_blob_shas: The files written to the staging snapshot so far, or
+        None to start over.
+
+  Returns:
+    The new task.
+  """
+  repo = GetRepo(repo_url)
+  repo.staging_blob_shas = staging_blob_shas
+  task = taskqueue.add(queue_name='repo',
+                       url='/_playground_tasks/populate_repo',
+                       params={'repo_url': repo_url},
+                       countdown=countdown,
+                       transactional=True)
+  repo.in_progress_task_name = task.name
+  project = repo.project.get()
+  if project.in_progress_task_name:
+    # a new template project remains unavailable until populated
+    project.in_progress_task_name = task.name
+    project.put()
+  repo.put()
+  return task
+
+
 def GetUser(user_id):
   return User.get_by_id(user_id, namespace=settings.PLAYGROUND_NAMESPACE)
 
 
 def GetOrCreateUser(user_id):
+  # optimistically try fast, transactionless get
+  user = GetUser(user_id)
+  if user:
+    return user
   return User.get_or_insert(user_id, namespace=settings.PLAYGROUND_NAMESPACE)
 
 
+def GetOrMakeUser(user_id):
+  """Get a user, or a new unsaved user entity.
+
+  Unsaved users are stored by their first state changing action, such as
+  CreateProject, so that read-only browsing performs no datastore writes.
+
+  Args:
+    user_id: The user id.
+
+  Returns:
+    The user entity.
+  """
+  user = GetUser(user_id)
+  if user:
+    return user
+  return User(id=user_id, namespace=settings.PLAYGROUND_NAMESPACE)
+
+
 def GetProjects(user):
   projects = ndb.get_multi(user.projects)
   if None in projects:
@@ -252,6 +643,63 @@ def GetProject(project_id):
   return project
 
 
+def _ProjectVersionKey(project_id):
+  return '{}{}'.format(_PROJECT_VERSION_MEMCACHE_PREFIX, project_id)
+
+
+def _InvalidateCachedProject(project_id):
+  """Invalidate cached copies of a project in all instances."""
+  _project_cache.Pop(project_id)
+
+  def _NewVersion():
+    memcache.set(_ProjectVersionKey(project_id), random.getrandbits(64),
+                 namespace=settings.PLAYGROUND_NAMESPACE)
+
+  # other instances must not cache the entity from before the commit under
+  # the new version
+  ndb.get_context().call_on_commit(_NewVersion)
+
+
+def GetCachedProject(project_id):
+  """Get a project, possibly from the instance-local project cache.
+
+  Cached projects are validated against a version in memcache which changes
+  whenever the project is written, which costs a memcache get rather than a
+  datastore get. Do not modify the returned entity.
+
+  Args:
+    project_id: The project id.
+
+  Returns:
+    The project entity or None.
+  """
+  try:
+    project_id = long(project_id)
+  except ValueError:
+    return None
+  # the version is read before the entity, so a concurrent write leaves the
+  # cached entity with an outdated version rather than the reverse
+  version_key = _ProjectVersionKey(project_id)
+  version = memcache.get(version_key, namespace=settings.PLAYGROUND_NAMESPACE)
+  if version is None:
+    version = random.getrandbits(64)
+    if not memcache.add(version_key, version,
+                        namespace=settings.PLAYGROUND_NAMESPACE):
+      version = memcache.get(version_key,
+                             namespace=settings.PLAYGROUND_NAMESPACE)
+  cached = _project_cache.Get(project_id)
+  if cached and version is not None and cached[0] == version:
+    return cached[1]
+  project = GetProject(project_id)
+  if project and version is not None:
+    _project_cache.Put(project_id, (version, project))
+  return project
+
+
+def GetProjectCacheStats():
+  return _project_cache.Stats()
+
+
 def GetPublicTemplateProjects():
   """Get template projects."""
   user = GetPublicTemplateOwner()
@@ -285,6 +733,8 @@ def CopyProject(owner, template_project, expiration_seconds,
   retries = 5
   for i in range(0, retries):
     try:
+      # files are materialized lazily, see cow_tree.CopyOnWriteTree
+      base_snapshot = GetTemplateSnapshot(template_project)
       project = CreateProject(
         owner=owner,
         template_url=template_project.template_url,
@@ -296,15 +746,10 @@ def CopyProject(owner, template_project, expiration_seconds,
         read_only_demo_url=template_project.read_only_demo_url,
         expiration_seconds=expiration_seconds,
         orderby=template_project.orderby,
-        in_progress_task_name='copy_project',
         download_filename=template_project.download_filename,
         is_read_only=template_project.is_read_only,
-        hide_template=template_project.hide_template)
-      src_tree = _CreateProjectTree(template_project)
-      dst_tree = _CreateProjectTree(project)
-      CopyTree(dst_tree, src_tree)
-      project.in_progress_task_name=None
-      project.put()
+        hide_template=template_project.hide_template,
+        base_snapshot=base_snapshot)
       return project
     except Exception, e:
       if i == retries - 1:
@@ -319,36 +764,257 @@ def CopyTree(dst_tree, src_tree):
 
 
 def ResetProject(project_id, project_tree):
-  project_tree.Clear()
   project = GetProject(project_id)
   repo = GetRepo(project.template_url)
   tp = repo.project.get()
-  template_tree = _CreateProjectTree(tp)
-  CopyTree(project_tree, template_tree)
+  base_snapshot = GetTemplateSnapshot(tp)
+  # discards materialized files and detaches from the previous snapshot
+  project_tree.Clear()
+  return SetProjectBaseSnapshot(project.key, base_snapshot)
+
+
+def _CreateSnapshotTree(snapshot):
+  return common.config.CREATE_TREE_FUNC(snapshot)
+
+
+def _GetSnapshotTemplateId(snapshot):
+  return snapshot.split('-')[1]
+
+
+def _NewSnapshotName(template_project):
+  return settings.SNAPSHOT_TREE_FORMAT.format(
+      template_project.key.id(), secret.GenerateRandomString(entropy=64))
+
+
+def GetTemplateSnapshot(template_project):
+  """Get the current immutable snapshot of a template project's files.
+
+  The snapshot is created by the first caller after each template
+  (re)population or write to the project's files; all later callers share
+  it until the next one.
+
+  Args:
+    template_project: The template project.
+
+  Returns:
+    The snapshot tree namespace.
+  """
+  # the cached entity may predate a write which invalidated the snapshot
+  project = template_project.key.get()
+  if project.current_snapshot:
+    return project.current_snapshot
+  content_updated = project.content_updated
+  snapshot = _NewSnapshotName(template_project)
+  CopyTree(_CreateSnapshotTree(snapshot), _CreateProjectTree(template_project))
+
+  @ndb.transactional
+  def _SetCurrentSnapshot():
+    prj = template_project.key.get()
+    if prj.current_snapshot:
+      return prj.current_snapshot
+    resolution = datetime.timedelta(
+        seconds=settings.CONTENT_UPDATED_RESOLUTION_SECONDS)
+    if (prj.content_updated != content_updated or
+        (content_updated and
+         datetime.datetime.now() - content_updated < resolution)):
+      # writes during the copy may be missing, and may not have marked the
+      # project; use the snapshot for this copy only
+      return snapshot
+    prj.current_snapshot = snapshot
+    prj.put()
+    return snapshot
+
+  current_snapshot = _SetCurrentSnapshot()
+  if current_snapshot != snapshot:
+    # another request beat us to it
+    _CreateSnapshotTree(snapshot).Clear()
+  return current_snapshot
+
+
+@ndb.transactional
+def NewTemplateSnapshot(template_project):
+  """Allocate a snapshot tree namespace in which to rebuild a template.
+
+  The snapshot is kept while the template's repo is being populated, and
+  deleted once it is neither published by SetTemplateSnapshot() nor still
+  being written.
+
+  Args:
+    template_project: The template project.
+
+  Returns:
+    The snapshot tree namespace.
+  """
+  project = template_project.key.get()
+  if project.staging_snapshot:
+    # left behind by an earlier population which did not complete
+    ScheduleSnapshotDeletion(project.staging_snapshot)
+  project.staging_snapshot = _NewSnapshotName(project)
+  project.put()
+  ScheduleSnapshotDeletion(
+      project.staging_snapshot,
+      countdown=settings.SNAPSHOT_STAGING_DELETION_DELAY_SECONDS)
+  return project.staging_snapshot
+
+
+@ndb.transactional
+def DiscardTemplateSnapshot(template_project_key, snapshot):
+  """Abandon a snapshot allocated by NewTemplateSnapshot() without using it.
+
+  Args:
+    template_project_key: The template project key.
+    snapshot: The snapshot tree namespace.
+
+  Returns:
+    The template project.
+  """
+  project = template_project_key.get()
+  if project.staging_snapshot == snapshot:
+    project.staging_snapshot = None
+    project.put()
+  ScheduleSnapshotDeletion(snapshot)
   return project
 
 
-def GetProjectData(project_id, project_tree):
-  """Get project data.
+@ndb.transactional(xg=True)
+def SetTemplateSnapshot(template_project_key, snapshot):
+  """Atomically switch a template project and new copies to a snapshot.
 
-  Used to the playground to provide project downloads.
+  The template project reads its files from the snapshot, and all later
+  copies share it. Replaced snapshots are deleted once unused.
 
   Args:
-    project_id: The project id.
-    project_tree: The project tree.
+    template_project_key: The template project key.
+    snapshot: The snapshot tree namespace.
+
   Returns:
-    Project data as a dict.
+    The template project.
+  """
+  project = template_project_key.get()
+  for replaced in set([project.current_snapshot, project.base_snapshot]):
+    if replaced and replaced != snapshot:
+      ScheduleSnapshotDeletion(replaced)
+  _MoveSnapshotReference(project.base_snapshot, snapshot)
+  project.current_snapshot = snapshot
+  project.base_snapshot = snapshot
+  if project.staging_snapshot == snapshot:
+    project.staging_snapshot = None
+  project.put()
+  return project
+
+
+@ndb.transactional(xg=True)
+def SetProjectBaseSnapshot(project_key, base_snapshot):
+  """Point a project at a different (or no) snapshot tree."""
+  project = project_key.get()
+  if project.base_snapshot and project.base_snapshot != base_snapshot:
+    ScheduleSnapshotDeletion(project.base_snapshot)
+  _MoveSnapshotReference(project.base_snapshot, base_snapshot)
+  project.base_snapshot = base_snapshot
+  project.put()
+  return project
+
+
+def _SnapshotReferencesKey(snapshot):
+  return ndb.Key(SnapshotReferences, snapshot,
+                 namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def _MoveSnapshotReference(old_snapshot, new_snapshot):
+  """Move a project's snapshot reference within the current transaction."""
+  if old_snapshot == new_snapshot:
+    return
+  deltas = {old_snapshot: -1, new_snapshot: 1}
+  keys = [_SnapshotReferencesKey(s) for s in deltas if s]
+  to_put = []
+  for key, refs in zip(keys, ndb.get_multi(keys)):
+    refs = refs or SnapshotReferences(key=key, count=0)
+    refs.count += deltas[key.id()]
+    to_put.append(refs)
+  ndb.put_multi(to_put)
+
+
+@ndb.transactional(xg=True)
+def _PutProjectWithSnapshotReference(project):
+  project.put()
+  _MoveSnapshotReference(None, project.base_snapshot)
+
+
+@ndb.transactional
+def _DeleteSnapshotReferencesIfUnused(snapshot):
+  refs = _SnapshotReferencesKey(snapshot).get()
+  if refs and refs.count > 0:
+    return False
+  if refs:
+    refs.key.delete()
+  return True
+
+
+@ndb.transactional
+def MarkProjectFilesMigrated(project_key):
+  """Record that a project's files have moved to a blob tree."""
+  project = project_key.get()
+  if not project.blob_files:
+    project.blob_files = True
+    project.put()
+  return project
+
+
+def ScheduleSnapshotDeletion(snapshot, countdown=None):
+  # delay gives in-flight CopyProject requests time to commit their reference
+  taskqueue.add(queue_name='snapshot',
+                url='/_playground_tasks/delete_snapshot',
+                params={'snapshot': snapshot},
+                countdown=countdown or settings.SNAPSHOT_DELETION_DELAY_SECONDS,
+                transactional=ndb.in_transaction())
+
+
+def DeleteSnapshotIfUnused(snapshot):
+  """Delete a snapshot tree which is no longer referenced by any project."""
+  template_project = GetProject(_GetSnapshotTemplateId(snapshot))
+  if template_project and template_project.current_snapshot == snapshot:
+    shared.i('keeping current template snapshot {}'.format(snapshot))
+    return
+  if template_project and template_project.staging_snapshot == snapshot:
+    repo = GetRepo(template_project.template_url)
+    if repo and repo.in_progress_task_name:
+      shared.i('keeping staging snapshot {} of task {}'
+               .format(snapshot, repo.in_progress_task_name))
+      ScheduleSnapshotDeletion(
+          snapshot, countdown=settings.SNAPSHOT_STAGING_DELETION_DELAY_SECONDS)
+      return
+  if not _DeleteSnapshotReferencesIfUnused(snapshot):
+    shared.i('keeping snapshot {} which is still in use'.format(snapshot))
+    return
+  shared.i('deleting unused snapshot {}'.format(snapshot))
+  _CreateSnapshotTree(snapshot).Clear()
+
+
+def GetProjectDownloadFilename(project):
+  if project.download_filename:
+    return project.download_filename
+  # keep in sync with app/js/controllers.js
+  return '{}.zip'.format(re.sub('[^a-zA-Z0-9-]', '_', project.project_name))
+
+
+def IterProjectFiles(project_tree, paths):
+  """Iterate over project files, reading one file at a time.
+
+  Used by the playground to provide project downloads.
+
+  Args:
+    project_tree: The project tree.
+    paths: The file paths, as returned by ListDirectory(None).
+
+  Yields:
+    (path, last_modified, contents) tuples.
   """
-  project = GetProject(project_id)
-  project_name = project.project_name
-  paths = project_tree.ListDirectory(None)
-  files = []
   for path in paths:
-    if os.path.isdir(path):
+    contents = project_tree.GetFileContents(path)
+    if contents is None:
+      # deleted since listing the tree
       continue
-    content = project_tree.GetFileContents(path)
-    files.append({'path': path, 'content': content})
-  return {'project_name': project_name, 'files': files}
+    yield path, project_tree.GetFileLastModified(path), contents
 
 
 def RenameProject(project_id, project_name):
@@ -452,7 +1118,8 @@ def CreateProject(owner, template_url, html_url, project_name,
                   read_only_demo_url, expiration_seconds, orderby=None,
                   in_progress_task_name=None,
                   download_filename=None,
-                  is_read_only=False, hide_template=False):
+                  is_read_only=False, hide_template=False,
+                  base_snapshot=None):
   """Create a new user project.
 
   Args:
@@ -473,6 +1140,8 @@ def CreateProject(owner, template_url, html_url, project_name,
     is_read_only: True if the project cannot be edited in the UI.
     hide_template: True if the project/template should not appear on the main
         page, such as for samples that don't actually run on CP.
+    base_snapshot: The snapshot tree namespace which the project files are
+        read from until they are first written, or None.
 
   Returns:
     The new project entity.
@@ -492,21 +1161,22 @@ def CreateProject(owner, template_url, html_url, project_name,
                 orderby=orderby,
                 in_progress_task_name=in_progress_task_name,
                 access_key=secret.GenerateRandomString(),
+                content_updated=datetime.datetime.now(),
                 namespace=settings.PLAYGROUND_NAMESPACE,
                 expiration_seconds=expiration_seconds,
                 download_filename=download_filename,
                 is_read_only=is_read_only,
-                hide_template=hide_template)
-  prj.put()
-  # transactional get before update
-  owner = owner.key.get()
+                hide_template=hide_template,
+                blob_files=True,
+                base_snapshot=base_snapshot)
+  if base_snapshot:
+    _PutProjectWithSnapshotReference(prj)
+  else:
+    prj.put()
+  # transactional get before update; anonymous users are created lazily
+  owner = owner.key.get() or User(key=owner.key)
   owner.projects.append(prj.key)
   owner.put()
-  # call taskqueue to schedule expiration
-  if expiration_seconds:
-    expiration_date = prj.updated + datetime.timedelta(0, expiration_seconds)
-    # explicit expiration_date avoids reading back all the files we just created
-    ScheduleExpiration(prj, expiration_date)
   return prj
 
 
@@ -518,28 +1188,89 @@ def GetProjectLastModified(project):
   Returns:
     A datetime object.
   """
-  last_modified = project.updated
+  if not project.content_updated:
+    # projects created before content_updated was maintained
+    project = _BackfillProjectContentUpdated(project)
+  return max(project.updated, project.content_updated)
+
+
+def _BackfillProjectContentUpdated(project):
+  content_updated = project.updated
   tree = _CreateProjectTree(project)
   paths = tree.ListDirectory(None)
   for path in paths:
     if path.endswith('/'):
       continue
     file_mtime = tree.GetFileLastModified(path)
-    if file_mtime > last_modified:
-      last_modified = file_mtime
-  return last_modified
+    if file_mtime > content_updated:
+      content_updated = file_mtime
+  return _SetProjectContentUpdated(project.key, content_updated)
+
+
+@ndb.transactional
+def _SetProjectContentUpdated(project_key, content_updated):
+  project = project_key.get()
+  if (not project.content_updated or
+      project.content_updated < content_updated):
+    project.content_updated = content_updated
+    project.put()
+  return project
+
+
+@ndb.transactional
+def _InvalidateCurrentSnapshot(project_key, content_updated):
+  project = project_key.get()
+  if project.current_snapshot:
+    if project.current_snapshot != project.base_snapshot:
+      ScheduleSnapshotDeletion(project.current_snapshot)
+    project.current_snapshot = None
+  if (not project.content_updated or
+      project.content_updated < content_updated):
+    project.content_updated = content_updated
+  project.put()
+  return project
 
 
-def ScheduleExpiration(project, expiration_date):
-  base_url = '/playground/p/{0}/check_expiration'
-  expiration_url = base_url.format(project.key.id())
-  if expiration_date is None:
-    # deteimne expiration date based on last file access
-    expiration_date = (GetProjectLastModified(project) +
-                       datetime.timedelta(0, project.expiration_seconds))
-  taskqueue.add(queue_name='expiration',
-                url=expiration_url,
-                eta=expiration_date)
+def MarkProjectContentUpdated(project):
+  """Advance a project's content_updated high-water mark.
+
+  Called on every tree write; the entity is only rewritten once per
+  CONTENT_UPDATED_RESOLUTION_SECONDS, or when the write invalidates the
+  snapshot which copies of the project are made from.
+
+  Args:
+    project: The playground project.
+
+  Returns:
+    The current project entity.
+  """
+  now = datetime.datetime.now()
+  if project.current_snapshot:
+    # later copies must see this write, see GetTemplateSnapshot()
+    return _InvalidateCurrentSnapshot(project.key, now)
+  resolution = datetime.timedelta(
+      seconds=settings.CONTENT_UPDATED_RESOLUTION_SECONDS)
+  if project.content_updated and now - project.content_updated < resolution:
+    return project
+  return _SetProjectContentUpdated(project.key, now)
+
+
+def BackfillProjectExpiration(project):
+  """Set expires on a project created before it was maintained.
+
+  The expiration time is based on the last modification of the project
+  rather than on the put which stores it, so that long abandoned projects
+  expire instead of getting a fresh lifetime. The caller puts the project.
+
+  Args:
+    project: the playground project
+  """
+  last_modified = max(project.updated,
+                      project.content_updated or project.updated)
+  project.expires = (last_modified +
+                     datetime.timedelta(0, project.expiration_seconds))
+  # pylint:disable-msg=protected-access
+  project._expires_backfilled = True
 
 
 def CheckExpiration(project):
@@ -547,21 +1278,28 @@ def CheckExpiration(project):
 
   Project expires if more than expiration_seconds
   seconds has elapsed since last modification.  Used
-  in the CheckExpiration request handler.
+  in the CheckExpiration request handler and by the expiration sweeper.
 
   Args:
     project: the playground project
+
+  Returns:
+    True if the project was deleted.
   """
   expiration_seconds = project.expiration_seconds
+  if not expiration_seconds:
+    return False
   now = datetime.datetime.now()
-  current_expiration_date = (GetProjectLastModified(project) +
-                             datetime.timedelta(0, expiration_seconds))
-  # Expire the project
-  if now > current_expiration_date:
-    DeleteProject(project)
-  # Defer expiration
+  if project.expires:
+    # maintained on every put, and backfilled from the last modification
+    current_expiration_date = project.expires
   else:
-    ScheduleExpiration(project, None)
+    current_expiration_date = (GetProjectLastModified(project) +
+                               datetime.timedelta(0, expiration_seconds))
+  if now <= current_expiration_date:
+    return False
+  DeleteProject(project)
+  return True
 
 
 @ndb.transactional()
@@ -11,6 +11,7 @@ import webapp2
 from . import appids
 from . import error
 from error import Abort
+from . import fetcher
 from . import fixit
 from . import jsonutil
 from . import middleware
@@ -19,8 +20,10 @@ from mimic.__mimic import mimic
 from . import model
 from . import settings
 from . import shared
+from template import github
 from template import templates
 from . import wsgi_config
+from . import zipstream
 
 from google.appengine.api import users
 
@@ -32,6 +35,10 @@ _DASH_DOT_DASH = '-dot-'
 # must fit in front of '-dot-appid.appspot.com' and not contain '-dot-'
 _VALID_PROJECT_RE = re.compile('^[a-z0-9-]{0,50}$')
 
+# characters not allowed in Content-Disposition filenames, which also rules
+# out quotes and CR/LF
+_UNSAFE_FILENAME_CHARS_RE = re.compile('[^a-zA-Z0-9_.-]')
+
 
 class JsonHandler(webapp2.RequestHandler):
   """Convenience request handler for handler JSON requests and responses."""
@@ -460,6 +467,26 @@ class ResetProject(PlaygroundHandler):
     return self.DictOfProject(project)
 
 
+class DownloadProject(PlaygroundHandler):
+  """Handler which streams a project as a ZIP archive."""
+
+  def PerformAccessCheck(self):
+    if not shared.HasProjectReadAccess(self.request.environ):
+      Abort(httplib.UNAUTHORIZED, 'no project read access')
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    filename = (self.request.get('filename') or
+                model.GetProjectDownloadFilename(self.project))
+    paths = [p for p in self.tree.ListDirectory(None) if not p.endswith('/')]
+    self.response.headers['Content-Type'] = 'application/zip'
+    filename = _UNSAFE_FILENAME_CHARS_RE.sub('_', filename)
+    self.response.headers['Content-Disposition'] = (
+        'attachment; filename="{}"'.format(filename))
+    # files may change while streaming, so the response is sent chunked
+    files = model.IterProjectFiles(self.tree, paths)
+    self.response.app_iter = zipstream.StreamZip(files)
+
+
 class UpdateProject(PlaygroundHandler):
   """Handler for updating project metadata."""
 
@@ -483,6 +510,34 @@ class Fixit(PlaygroundHandler):
     self.response.write('Fixit begun')
 
 
+class CacheStats(PlaygroundHandler):
+  """Admin only handler for inspecting instance-local cache statistics."""
+
+  def PerformAccessCheck(self):
+    shared.AssertIsAdmin()
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    return {
+        'project_cache': model.GetProjectCacheStats(),
+    }
+
+
+class RateLimitStats(PlaygroundHandler):
+  """Admin only handler for inspecting rate limit budgets and their usage."""
+
+  def PerformAccessCheck(self):
+    shared.AssertIsAdmin()
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    usage_keys = [c.key.id() for c in templates.GetRepoCollections()]
+    # repos which were not discovered by a collection
+    usage_keys.extend(settings.PROJECT_TEMPLATE_OWNERS)
+    return {
+        'budgets': {github.API_HOST: fetcher.GetRateLimit(github.API_HOST)},
+        'usage': fetcher.GetUsage(usage_keys),
+    }
+
+
 class Nuke(PlaygroundHandler):
   """Admin only handler for reseting global data."""
 
@@ -506,6 +561,11 @@ class CheckExpiration(webapp2.RequestHandler):
     if project == settings.NO_SUCH_PROJECT:
       # project already deleted
       return
+    # the environ project may be cached, and stale with respect to content
+    # updates made by other instances
+    project = model.GetProject(project.key.id())
+    if not project:
+      return
     model.CheckExpiration(project)
 
 app = webapp2.WSGIApplication([
@@ -523,10 +583,13 @@ app = webapp2.WSGIApplication([
     ('/playground/p/.*/rename', RenameProject),
     ('/playground/p/.*/update', UpdateProject),
     ('/playground/p/.*/reset', ResetProject),
+    ('/playground/p/.*/download', DownloadProject),
 
     # admin tools
     ('/playground/nuke', Nuke),
     ('/playground/fixit', Fixit),
+    ('/playground/cache_stats', CacheStats),
+    ('/playground/rate_limit_stats', RateLimitStats),
     ('/playground/oauth2_admin', OAuth2Admin),
 
     # /playground
@@ -68,12 +68,127 @@ MIN_EXPIRATION_SECONDS = 3600
 # One week
 DEFAULT_EXPIRATION_SECONDS = 604800
 
+# One minute
+CONTENT_UPDATED_RESOLUTION_SECONDS = 60
+
+# maximum number of Project entities cached per instance
+PROJECT_CACHE_SIZE = 1000
+
+# limits staleness should memcache lose the version which validates cached
+# projects, see model.GetCachedProject()
+PROJECT_CACHE_TTL_SECONDS = 10
+
+# bytes of file content cached per instance by CachingUrlFetchTree
+URLFETCH_FILE_CACHE_BYTES = 16 * 1024 * 1024
+
+# maximum number of directory listings cached per instance by UrlFetchTree
+URLFETCH_LISTING_CACHE_SIZE = 1000
+
+# bytes of project archives cached per instance by ZipUrlFetchTree
+ZIP_ARCHIVE_CACHE_BYTES = 32 * 1024 * 1024
+
+# larger project archives are only held for the request which downloaded them,
+# so a few large projects cannot pin most of an instance's memory
+ZIP_ARCHIVE_CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+
+# larger changes to a cached project archive, including those applied since
+# it was downloaded, cause a full download
+ZIP_SYNC_MAX_BYTES = 1024 * 1024
+
+# maximum number of files per batch file control request
+URLFETCH_BATCH_FILES = 100
+
+# maximum encoded file contents per batch PUT, well below URL Fetch limits
+URLFETCH_BATCH_BYTES = 4 * 1024 * 1024
+
+# maximum length of the path query parameters of a batch GET
+URLFETCH_BATCH_QUERY_LENGTH = 2000
+
+# paths per cross-group transaction; each path touches the tree entity group
+# and up to two blob entity groups, which must not exceed 25 entity groups
+TREE_FILE_TRANSACTION_SIZE = 12
+
+# new blob content bytes per transaction, well below the 10MB limit
+BLOB_TRANSACTION_BYTES = 4 * 1024 * 1024
+
+# snapshot tree namespace, formatted with template project id and random suffix
+SNAPSHOT_TREE_FORMAT = 'snapshot-{0}-{1}'
+
+# Ten minutes
+SNAPSHOT_DELETION_DELAY_SECONDS = 600
+
+# One hour; unpublished staging snapshots are checked at this interval, and
+# deleted once no task is populating their template
+SNAPSHOT_STAGING_DELETION_DELAY_SECONDS = 3600
+
+# number of concurrent expiration sweeper tasks
+EXPIRATION_SHARDS = 8
+
+# resources up to this size are also cached in memcache
+RESOURCE_MEMCACHE_MAX_BYTES = 100 * 1024
+
+# One day
+RESOURCE_ACCESS_RESOLUTION_SECONDS = 86400
+
+# least recently used resources beyond this number are evicted
+RESOURCE_CACHE_MAX_ENTRIES = 20000
+
+# 30 days, resources not accessed for longer are evicted
+RESOURCE_CACHE_MAX_AGE_SECONDS = 2592000
+
+# seconds a url fetch lease is held, and its result kept for followers in
+# other instances which would otherwise fetch the same url
+FETCH_LEASE_SECONDS = 15
+
+# maximum seconds a follower waits for the leader of a url fetch
+FETCH_LEASE_WAIT_SECONDS = 10
+
+# seconds between checks of a url fetch lease held by another instance
+FETCH_LEASE_POLL_SECONDS = 0.25
+
+# maximum concurrent URL Fetch calls per FetchScheduler, in total and per host
+FETCH_MAX_IN_FLIGHT = 10
+FETCH_MAX_IN_FLIGHT_PER_HOST = 6
+
+# retries of URL Fetch errors and 5xx responses by FetchScheduler
+FETCH_RETRIES = 3
+
+# initial delay between retries, doubled with each attempt and jittered
+FETCH_RETRY_DELAY_SECONDS = 1
+
+# number of completed fetches between FetchScheduler progress log messages
+FETCH_PROGRESS_INTERVAL = 25
+
+# fraction of a host's rate limit held back from its budget as a margin for
+# fetches already in flight; beyond it population tasks wait for the budget
+# to reset
+RATE_LIMIT_RESERVE_FRACTION = 0.01
+
+# maximum random delay added to deferred population tasks, to spread them out
+RATE_LIMIT_DEFER_JITTER_SECONDS = 300
+
 # sentinnel value indicating a missing project
 NO_SUCH_PROJECT = 'NO_SUCH_PROJECT'
 
 # Extensions to exclude when creating template projects
 SKIP_EXTENSIONS = ('swp', 'pyc', 'svn')
 
+# populate github templates from a single archive of the branch head commit,
+# rather than fetching every file through the API
+GITHUB_FETCH_ARCHIVE = True
+
+# github archive url, formatted with owner, repo and ref, which must serve a
+# gzipped tarball; may be pointed at a local server for testing
+GITHUB_ARCHIVE_URL_FORMAT = ('https://api.github.com/repos/{owner}/{repo}'
+                             '/tarball/{ref}')
+
+# URL Fetch deadline for github archive downloads
+GITHUB_ARCHIVE_DEADLINE_SECONDS = 60
+
+# github files are written to the tree in batches of this many bytes of file
+# contents as they are fetched or extracted
+GITHUB_WRITE_BATCH_BYTES = 4 * 1024 * 1024
+
 if _DEV_MODE:
   PLAYGROUND_HOSTS = ['localhost:8080', '127.0.0.1:8080',
                       # port 7070 for karma e2e test
@@ -13,6 +13,7 @@ from . import settings
 
 from google.appengine.api import app_identity
 from google.appengine.api import backends
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.api import urlfetch
 
@@ -47,10 +48,11 @@ def w(msg, *args, **kwargs):  # pylint:disable-msg=invalid-name
 
 
 def Fetch(access_key, url, method, payload=None, deadline=_URL_FETCH_DEADLINE,
-          retries=1):
+          retries=1, headers=None):
+  headers = dict(headers or {})
+  headers[settings.ACCESS_KEY_HTTP_HEADER] = access_key
   for i in range(0, retries):
     try:
-      headers = {settings.ACCESS_KEY_HTTP_HEADER: access_key}
       return urlfetch.fetch(url, headers=headers, method=method,
                             payload=payload, follow_redirects=False,
                             deadline=deadline)
@@ -60,6 +62,39 @@ def Fetch(access_key, url, method, payload=None, deadline=_URL_FETCH_DEADLINE,
       w('Will retry {} {} which encountered {}'.format(method, url, e))
 
 
+def IncrementStats(key_prefix, counts, elapsed_seconds):
+  """Accumulate the counts and run time of a task in memcache.
+
+  Run time is accumulated as integer milliseconds, since memcache can only
+  offset integers.
+
+  Args:
+    key_prefix: The memcache key prefix of the statistics.
+    counts: A dict of statistic name to integer count.
+    elapsed_seconds: The run time of the task in seconds.
+  """
+  offsets = dict(counts, milliseconds=int(round(elapsed_seconds * 1000)))
+  memcache.offset_multi(offsets, key_prefix=key_prefix,
+                        namespace=settings.PLAYGROUND_NAMESPACE,
+                        initial_value=0)
+
+
+def GetStats(key_prefix, names):
+  """Get statistics accumulated by IncrementStats().
+
+  Args:
+    key_prefix: The memcache key prefix of the statistics.
+    names: The names of the counts.
+
+  Returns:
+    A dict of statistic name to value, including 'milliseconds'.
+  """
+  names = tuple(names) + ('milliseconds',)
+  stats = memcache.get_multi(names, key_prefix=key_prefix,
+                             namespace=settings.PLAYGROUND_NAMESPACE)
+  return dict((k, stats.get(k, 0)) for k in names)
+
+
 def GetCurrentTaskName():
   return os.environ.get('HTTP_X_APPENGINE_TASKNAME')
 
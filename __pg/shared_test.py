@@ -0,0 +1,39 @@
+"""Tests for shared.py."""
+
+import unittest
+
+from google.appengine.ext import testbed
+
+from . import shared
+
+
+class StatsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testDefaults(self):
+    self.assertEqual({'deleted': 0, 'milliseconds': 0},
+                     shared.GetStats('stats:', ['deleted']))
+
+  def testIncrement(self):
+    shared.IncrementStats('stats:', {'deleted': 3, 'failed': 1}, 1.5)
+    shared.IncrementStats('stats:', {'deleted': 2, 'failed': 0}, 0.25)
+    self.assertEqual({'deleted': 5, 'failed': 1, 'milliseconds': 1750},
+                     shared.GetStats('stats:', ['deleted', 'failed']))
+
+  def testSubSecondRunTimesAccumulate(self):
+    for _ in range(10):
+      shared.IncrementStats('stats:', {}, 0.0004)
+      shared.IncrementStats('stats:', {}, 0.0126)
+    self.assertEqual(130, shared.GetStats('stats:', [])['milliseconds'])
+
+  def testKeyPrefixesAreSeparate(self):
+    shared.IncrementStats('a:', {'deleted': 1}, 1)
+    self.assertEqual({'deleted': 0, 'milliseconds': 0},
+                     shared.GetStats('b:', ['deleted']))
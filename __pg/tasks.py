@@ -1,13 +1,26 @@
 """Module containing template WSGI handlers."""
 
+import random
+import time
+
 import webapp2
 
+from google.appengine.api import taskqueue
+
+from . import fetcher
 from . import model
+from . import settings
 from . import shared
 
 from template import templates
 
 
+def _GetDeferralSeconds(e):
+  """Seconds to wait for a rate limit to reset, plus jitter."""
+  jitter = random.uniform(0, settings.RATE_LIMIT_DEFER_JITTER_SECONDS)
+  return max(0, e.reset - time.time()) + jitter
+
+
 class PopulateRepoCollection(webapp2.RequestHandler):
 
   def post(self):  # pylint:disable-msg=invalid-name
@@ -17,7 +30,18 @@ class PopulateRepoCollection(webapp2.RequestHandler):
     collection = templates.GetCollection(repo_collection_url)
     if not collection:
       shared.e('missing repo collection {}'.format(repo_collection_url))
-    collection.PopulateRepos()
+    fetcher.SetUsageKey(repo_collection_url)
+    try:
+      collection.PopulateRepos()
+    except fetcher.RateLimitError, e:
+      countdown = _GetDeferralSeconds(e)
+      taskqueue.add(queue_name='repo',
+                    url='/_playground_tasks/populate_repo_collection',
+                    params={'repo_collection_url': repo_collection_url},
+                    countdown=countdown)
+      shared.w('{}; deferring population of repo collection {} by {:.0f}s'
+               .format(e, repo_collection_url, countdown))
+      return
     templates.ClearCache()
 
 
@@ -33,10 +57,26 @@ class PopulateRepo(webapp2.RequestHandler):
       project = repo.project.get()
       model.DeleteProject(project)
       return
-    collection.CreateTemplateProject(repo)
+    fetcher.SetUsageKey(repo.collection_url or repo.owner)
+    try:
+      collection.CreateTemplateProject(repo)
+    except fetcher.RateLimitError, e:
+      countdown = _GetDeferralSeconds(e)
+      task = model.DeferRepoPopulation(repo_url, countdown,
+                                       repo.staging_blob_shas)
+      shared.w('{}; deferring population of repo {} by {:.0f}s to task {}'
+               .format(e, repo_url, countdown, task.name))
+
+
+class DeleteSnapshot(webapp2.RequestHandler):
+
+  def post(self):  # pylint:disable-msg=invalid-name
+    snapshot = self.request.get('snapshot')
+    model.DeleteSnapshotIfUnused(snapshot)
 
 
 app = webapp2.WSGIApplication([
     ('/_playground_tasks/populate_repo_collection', PopulateRepoCollection),
     ('/_playground_tasks/populate_repo', PopulateRepo),
+    ('/_playground_tasks/delete_snapshot', DeleteSnapshot),
 ], debug=True)
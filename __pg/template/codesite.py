@@ -44,7 +44,9 @@ class CodesiteRepoCollection(collection.RepoCollection):
   def PopulateRepos(self):
     shared.EnsureRunningInTask()  # gives us automatic retries
     baseurl = self.repo_collection.key.id()
-    fetched = fetcher.Fetcher(baseurl, follow_redirects=True)
+    scheduler = fetcher.FetchScheduler(baseurl)
+    fetched = fetcher.Fetcher(baseurl, follow_redirects=True,
+                              scheduler=scheduler)
     page = fetched.content
     candidate_repos = self._GetChildPaths(page)
     fetches = []
@@ -62,8 +64,10 @@ class CodesiteRepoCollection(collection.RepoCollection):
         continue
       project_url = '{0}{1}'.format(baseurl, c)
       app_yaml_url = '{0}app.yaml'.format(project_url)
-      fetched = fetcher.Fetcher(app_yaml_url, follow_redirects=True)
-      fetches.append((c, project_url, app_yaml_url, fetched))
+      fetches.append((c, project_url, app_yaml_url))
+    pool = fetcher.FetcherPool([f[2] for f in fetches],
+                               follow_redirects=True, scheduler=scheduler)
+    fetches = [f + (app_yaml,) for f, app_yaml in zip(fetches, pool)]
 
     for c, project_url, app_yaml_url, fetched in fetches:
       try:
@@ -77,7 +81,8 @@ class CodesiteRepoCollection(collection.RepoCollection):
                               description=description,
                               show_files=[],
                               read_only_files=[],
-                              read_only_demo_url=None)
+                              read_only_demo_url=None,
+                              collection_url=baseurl)
       except urlfetch_errors.Error:
         exc_info = sys.exc_info()
         formatted_exception = traceback.format_exception(exc_info[0],
@@ -86,23 +91,31 @@ class CodesiteRepoCollection(collection.RepoCollection):
         shared.w('skipping {0}'.format(project_url))
         for line in [line for line in formatted_exception if line]:
           shared.w(line)
+    pool.Flush()
 
   def CreateProjectTreeFromRepo(self, tree, repo):
     repo_url = repo.key.id()
-
-    def AddFiles(dirname):
-      url = os.path.join(repo_url, dirname)
-      fetched = fetcher.Fetcher(url, follow_redirects=True)
-      page = fetched.content
-      paths = self._GetChildPaths(page)
-      shared.i('{0} -> {1}', url, paths)
-      if not paths:
-        shared.i('- {0}'.format(dirname))
-        tree.SetFile(dirname, page)
-      for path in paths:
-        if common.GetExtension(path) in settings.SKIP_EXTENSIONS:
-          continue
-        relpath = os.path.join(dirname, path)
-        AddFiles(relpath)
-
-    AddFiles('')
+    scheduler = fetcher.FetchScheduler(repo_url)
+
+    # fetch one directory level at a time
+    files = {}
+    dirnames = ['']
+    while dirnames:
+      urls = [os.path.join(repo_url, dirname) for dirname in dirnames]
+      pool = fetcher.FetcherPool(urls, follow_redirects=True,
+                                 scheduler=scheduler)
+      children = []
+      for dirname, url, fetched in zip(dirnames, urls, pool):
+        page = fetched.content
+        paths = self._GetChildPaths(page)
+        shared.i('{0} -> {1}', url, paths)
+        if not paths:
+          shared.i('- {0}'.format(dirname))
+          files[dirname] = page
+        for path in paths:
+          if common.GetExtension(path) in settings.SKIP_EXTENSIONS:
+            continue
+          children.append(os.path.join(dirname, path))
+      pool.Flush()
+      dirnames = children
+    collection.SetFiles(tree, files)
@@ -3,15 +3,29 @@
 
 import json
 
+from .. import cow_tree
+from .. import fetcher
 from .. import model
 from .. import shared
 
-from mimic.__mimic import common
-
 
 _PLAYGROUND_SETTINGS_FILENAME = '.playground'
 
 
+def SetFiles(tree, files):
+  """Write many files, in bulk if the tree supports it.
+
+  Args:
+    tree: The Tree to write to.
+    files: A dict mapping file paths to contents.
+  """
+  if hasattr(tree, 'SetFiles'):
+    tree.SetFiles(files)
+    return
+  for path, contents in files.iteritems():
+    tree.SetFile(path, contents)
+
+
 class RepoCollection(object):
   """An abstract base class for accessing a collection of code repositories."""
 
@@ -24,15 +38,42 @@ class RepoCollection(object):
     self.repo_collection = repo_collection
 
   def CreateTemplateProject(self, repo):
+    """Rebuild a template project without making it unavailable.
+
+    Files are written to a staging snapshot tree, which then atomically
+    replaces the snapshot that the template project and new copies read
+    from. Existing copies keep reading from their own snapshot.
+
+    Args:
+      repo: The Repo entity.
+    """
     shared.EnsureRunningInTask()  # gives us automatic retries
-    task_name = shared.GetCurrentTaskName()
-    template_project = model.SetProjectOwningTask(repo.project, task_name)
-    tree = common.config.CREATE_TREE_FUNC(str(template_project.key.id()))
-    tree.Clear()
-    self.CreateProjectTreeFromRepo(tree, repo)
-    self.ParseAndApplyProjectSettings(tree, template_project)
+    template_project = repo.project.get()
+    resume = (repo.staging_blob_shas is not None and
+              bool(template_project.staging_snapshot))
+    if not resume:
+      repo.staging_blob_shas = None
+    tree = cow_tree.CreateStagingTree(template_project, resume=resume)
+    try:
+      updated = self.UpdateProjectTreeFromRepo(tree, repo)
+    except fetcher.RateLimitError:
+      if not tree.changed:
+        # nothing written yet, the next attempt starts over
+        repo.staging_blob_shas = None
+      raise
+    if updated:
+      template_project = cow_tree.PublishStagingTree(repo.project, tree)
+      shared.i('published template project {} snapshot {}'
+               .format(template_project.key.id(), tree.namespace))
+      self.ParseAndApplyProjectSettings(tree, template_project)
+    else:
+      cow_tree.DiscardStagingTree(repo.project, tree)
+      shared.i('template project {} is up to date with {}'
+               .format(template_project.key.id(), repo.key.id()))
+    # newly created template projects are unavailable until first populated
     template_project = model.SetProjectOwningTask(repo.project, None)
     repo.in_progress_task_name = None
+    repo.staging_blob_shas = None
     repo.put()
 
   def ParseAndApplyProjectSettings(self, tree, project):
@@ -59,6 +100,24 @@ class RepoCollection(object):
     """Populate repos for this collection."""
     raise NotImplementedError
 
+  def UpdateProjectTreeFromRepo(self, tree, repo):
+    """Bring a previously populated project up to date with its repository.
+
+    The default implementation repopulates the entire tree. Subclasses may
+    record state on the repo to write only what changed, and record the files
+    written so far in repo.staging_blob_shas to resume after a RateLimitError.
+
+    Args:
+      tree: The Tree to update.
+      repo: The Repo entity, which is put by the caller.
+
+    Returns:
+      True if the tree may have changed.
+    """
+    tree.Clear()
+    self.CreateProjectTreeFromRepo(tree, repo)
+    return True
+
   def CreateProjectTreeFromRepo(self, tree, repo):
     """Populate project from code repository.
 
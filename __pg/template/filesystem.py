@@ -41,7 +41,8 @@ class FilesystemRepoCollection(collection.RepoCollection):
                             show_files=[],
                             read_only_files=[],
                             read_only_demo_url=None,
-                            orderby=None)
+                            orderby=None,
+                            collection_url=template_dir)
 
   def CreateProjectTreeFromRepo(self, tree, repo):
     repo_url = repo.key.id()
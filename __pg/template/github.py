@@ -1,13 +1,18 @@
 """Module for accessing github.com projects."""
 
 import base64
+import cStringIO
 import re
 import sys
+import tarfile
 import traceback
 import yaml
 
+from mimic.__mimic import common
+
 from .. import fetcher
 from .. import model
+from .. import settings
 from .. import shared
 
 from . import collection
@@ -15,6 +20,9 @@ from . import collection
 from google.appengine.api import urlfetch_errors
 
 
+# host of the rate limited github API
+API_HOST = 'api.github.com'
+
 _GITHUB_URL_RE = re.compile(
     r'^(?:https?|git)://(?:[^/]+.)?github.com/(.+?)(?:\.git)?$'
 )
@@ -93,6 +101,10 @@ class Info(object):
   def RepositoryUrl(self):
     return 'https://api.github.com/repos/{owner}/{repo}'.format(**self.__dict__)
 
+  def ArchiveUrl(self, ref):
+    return settings.GITHUB_ARCHIVE_URL_FORMAT.format(owner=self.owner,
+                                                     repo=self.repo, ref=ref)
+
   def BranchesUrl(self):
     if self.branch is None:
       fetched = FetchAsyncWithAuth(self.RepositoryUrl())
@@ -138,15 +150,55 @@ def IsValidUrl(url):
   return _GITHUB_URL_RE.match(url)
 
 
-def FetchAsyncWithAuth(*args, **kwargs):
+def _GetUrlAuthSuffix():
   credential = model.GetOAuth2Credential('github')
   if credential:
-    url_auth_suffix = ('?client_id={0}&client_secret={1}'
-                       .format(credential.client_id,
-                               credential.client_secret))
-  else:
-    url_auth_suffix = ''
-  return fetcher.Fetcher(*args, url_auth_suffix=url_auth_suffix, **kwargs)
+    return ('?client_id={0}&client_secret={1}'
+            .format(credential.client_id, credential.client_secret))
+  return ''
+
+
+def FetchAsyncWithAuth(*args, **kwargs):
+  return fetcher.Fetcher(*args, url_auth_suffix=_GetUrlAuthSuffix(), **kwargs)
+
+
+def FetchManyAsyncWithAuth(*args, **kwargs):
+  return fetcher.FetcherPool(*args, url_auth_suffix=_GetUrlAuthSuffix(),
+                             **kwargs)
+
+
+def _ExtractTarball(content):
+  """Extract the files from a github repository archive.
+
+  Members are read sequentially from the gzip stream. The top level
+  directory, named after the repository and commit, is stripped from all
+  paths.
+
+  Args:
+    content: The gzipped tar archive.
+
+  Yields:
+    (path, contents) tuples, excluding SKIP_EXTENSIONS. Paths are unicode,
+    like the paths of the github API.
+  """
+  archive = tarfile.open(fileobj=cStringIO.StringIO(content), mode='r|gz')
+  try:
+    for member in archive:
+      if not member.isfile():
+        continue
+      path = member.name.decode('utf-8', 'replace').partition(u'/')[2]
+      if not path or common.GetExtension(path) in settings.SKIP_EXTENSIONS:
+        continue
+      yield path, archive.extractfile(member).read()
+  finally:
+    archive.close()
+
+
+def _WriteFiles(tree, files, written):
+  """Write a batch of files and add their paths to the written set."""
+  if files:
+    collection.SetFiles(tree, files)
+    written.update(files)
 
 
 class GithubRepoCollection(collection.RepoCollection):
@@ -200,8 +252,11 @@ class GithubRepoCollection(collection.RepoCollection):
              if self._IsAppEnginePythonRepo(entry['name'])
              and entry['html_url'] not in _PROJECT_URL_SKIP_LIST]
 
+    # bounds concurrent fetches across all stages
+    scheduler = fetcher.FetchScheduler(self.repo_collection.key.id())
+
     # fetch master_branch url for each repo
-    candidates1 = []
+    candidates = []
     for repo in repos:
       # only proceed with repos which look like App Engine Python projects
       if not self._IsAppEnginePythonRepo(repo['name']):
@@ -211,12 +266,13 @@ class GithubRepoCollection(collection.RepoCollection):
 
       info = Info(user=repo['owner']['login'], repo=repo['name'],
                   branch=repo['master_branch'])
-      branches_url = info.BranchesUrl()
-      fetched = FetchAsyncWithAuth(branches_url)
-      candidates1.append((repo, fetched))
+      candidates.append((repo, info.BranchesUrl()))
+    pool = FetchManyAsyncWithAuth([url for _, url in candidates],
+                                  scheduler=scheduler)
+    candidates1 = zip([repo for repo, _ in candidates], pool)
 
     # fetch tree url for each repo
-    candidates2 = []
+    candidates = []
     for repo, fetched in candidates1:
       try:
         data = fetched.json_content
@@ -225,12 +281,14 @@ class GithubRepoCollection(collection.RepoCollection):
 
       # see http://developer.github.com/v3/git/trees/
       tree_url = data['commit']['commit']['tree']['url'] + '?recursive=1'
-
-      fetched = FetchAsyncWithAuth(tree_url)
-      candidates2.append((repo, fetched))
+      candidates.append((repo, tree_url))
+    pool.Flush()
+    pool = FetchManyAsyncWithAuth([url for _, url in candidates],
+                                  scheduler=scheduler)
+    candidates2 = zip([repo for repo, _ in candidates], pool)
 
     # filter for trees containing 'app.yaml'
-    candidates3 = []
+    candidates = []
     for repo, fetched in candidates2:
       data = fetched.json_content
 
@@ -242,8 +300,11 @@ class GithubRepoCollection(collection.RepoCollection):
         shared.w('skipping repo due to missing app.yaml: {}'
                  .format(repo['html_url']))
         continue
-      fetched = FetchAsyncWithAuth(app_yaml_urls[0])
-      candidates3.append((repo, fetched))
+      candidates.append((repo, app_yaml_urls[0]))
+    pool.Flush()
+    pool = FetchManyAsyncWithAuth([url for _, url in candidates],
+                                  scheduler=scheduler)
+    candidates3 = zip([repo for repo, _ in candidates], pool)
 
     # filter repos whose app.yaml does not contain 'runtime: python27'
     for repo, fetched in candidates3:
@@ -257,6 +318,7 @@ class GithubRepoCollection(collection.RepoCollection):
                  .format(runtime, repo['html_url']))
         continue
       repos.append(repo)
+    pool.Flush()
 
     return repos
 
@@ -286,7 +348,62 @@ class GithubRepoCollection(collection.RepoCollection):
                             description=description,
                             show_files=[],
                             read_only_files=[],
-                            read_only_demo_url=None)
+                            read_only_demo_url=None,
+                            collection_url=repo_collection_url)
+
+  def UpdateProjectTreeFromRepo(self, tree, repo):
+    """Write and delete only the files which changed since the last update.
+
+    The git tree and blob SHAs are recorded on the repo. When the root tree
+    is unchanged only the branch is fetched. Files are recorded in
+    repo.staging_blob_shas as they are written, so that a population
+    interrupted by the rate limit resumes where it left off.
+
+    Args:
+      tree: The Tree to update.
+      repo: The Repo entity, which is put by the caller.
+
+    Returns:
+      True if the tree may have changed.
+    """
+    info = GetInfo(repo.key.id())
+    branch = FetchAsyncWithAuth(info.BranchesUrl()).json_content
+    tree_sha = branch['commit']['commit']['tree']['sha']
+    if repo.blob_shas is not None and repo.tree_sha == tree_sha:
+      return False
+    entries = self._GetTreeEntries(branch)
+    blob_shas = dict((entry['path'], entry['sha']) for entry in entries)
+    if repo.staging_blob_shas is None:
+      if repo.blob_shas is None:
+        tree.Clear()
+      repo.staging_blob_shas = dict(repo.blob_shas or {})
+    progress = repo.staging_blob_shas
+    changed = [entry for entry in entries
+               if progress.get(entry['path']) != entry['sha']]
+    removed = [path for path in progress if path not in blob_shas]
+    shared.i('updating {} changed and {} removed files from {}'
+             .format(len(changed), len(removed), repo.key.id()))
+    for path in removed:
+      tree.DeletePath(path)
+      del progress[path]
+    written = set()
+    try:
+      if progress:
+        self._SetFilesFromBlobs(tree, info, changed, written)
+      else:
+        self._PopulateTree(tree, info, branch, changed, written)
+    finally:
+      progress.update((path, blob_shas[path]) for path in written
+                      if path in blob_shas)
+    missing = [entry['path'] for entry in changed
+               if entry['path'] not in written]
+    for path in missing:
+      # retried by the next update
+      del blob_shas[path]
+    repo.tree_sha = None if missing else tree_sha
+    repo.blob_shas = blob_shas
+    repo.staging_blob_shas = None
+    return True
 
   def CreateProjectTreeFromRepo(self, tree, repo):
     # e.g. https://github.com/GoogleCloudPlatform/appengine-guestbook-python
@@ -297,30 +414,130 @@ class GithubRepoCollection(collection.RepoCollection):
     # e.g. https://api.github.com/repos/GoogleCloudPlatform/appengine-guestbook-python/branches/part6-staticfiles
     branches_url = info.BranchesUrl()
     fetched = FetchAsyncWithAuth(branches_url)
-    data = fetched.json_content
+    self._PopulateTree(tree, info, fetched.json_content)
+
+  def _PopulateTree(self, tree, info, branch, entries=None, written=None):
+    """Populate a tree with the files of a branch.
+
+    Args:
+      tree: The Tree to populate.
+      info: The Info for the repo.
+      branch: The JSON parsed branch.
+      entries: The branch tree entries, if already fetched.
+      written: A set to which written file paths are added, or None.
 
+    Returns:
+      The set of written file paths.
+    """
+    if written is None:
+      written = set()
+    if settings.GITHUB_FETCH_ARCHIVE:
+      try:
+        return self._CreateProjectTreeFromArchive(tree, info,
+                                                  branch['commit']['sha'],
+                                                  written)
+      except (urlfetch_errors.Error, tarfile.TarError, IOError), e:
+        shared.w('unable to populate {}/{} from archive, fetching files '
+                 'individually: {}'.format(info.owner, info.repo, e))
+    if entries is None:
+      entries = self._GetTreeEntries(branch)
+    return self._SetFilesFromBlobs(tree, info, entries, written)
+
+  def _CreateProjectTreeFromArchive(self, tree, info, commit_sha, written):
+    """Populate a tree from a single archive of the given commit.
+
+    The archive is only read once, so it bypasses the Resource cache. Files
+    are written in batches as they are extracted.
+
+    Args:
+      tree: The Tree to populate.
+      info: The Info for the repo.
+      commit_sha: The commit to fetch.
+      written: A set to which written file paths are added.
+
+    Returns:
+      The set of written file paths.
+    """
+    response = fetcher.FetchUncachedAsync(
+        info.ArchiveUrl(commit_sha), url_auth_suffix=_GetUrlAuthSuffix(),
+        follow_redirects=True,
+        deadline=settings.GITHUB_ARCHIVE_DEADLINE_SECONDS).get_result()
+    batch = {}
+    batch_bytes = 0
+    for path, contents in _ExtractTarball(response.content):
+      batch[path] = contents
+      batch_bytes += len(contents)
+      if batch_bytes >= settings.GITHUB_WRITE_BATCH_BYTES:
+        _WriteFiles(tree, batch, written)
+        batch = {}
+        batch_bytes = 0
+    _WriteFiles(tree, batch, written)
+    shared.i('extracted {} files from {} byte archive of {}/{}'
+             .format(len(written), len(response.content), info.owner,
+                     info.repo))
+    return written
+
+  def _GetTreeEntries(self, branch):
+    """Get the file entries of a branch, excluding SKIP_EXTENSIONS.
+
+    Args:
+      branch: The JSON parsed branch.
+
+    Returns:
+      A list of JSON parsed blob entries of the recursive tree listing.
+    """
     # see http://developer.github.com/v3/git/trees/
-    tree_url = data['commit']['commit']['tree']['url'] + '?recursive=1'
+    tree_url = branch['commit']['commit']['tree']['url'] + '?recursive=1'
     fetched = FetchAsyncWithAuth(tree_url)
     data = fetched.json_content
+    return [entry for entry in data['tree'] if entry['type'] == 'blob'
+            and common.GetExtension(entry['path'])
+            not in settings.SKIP_EXTENSIONS]
 
-    entries = [entry for entry in data['tree'] if entry['type'] == 'blob']
-    fetches = []
-    for entry in entries:
-      fetched = FetchAsyncWithAuth(entry['url'])
-      fetches.append((entry, fetched))
+  def _SetFilesFromBlobs(self, tree, info, entries, written=None):
+    """Fetch files individually and write them to a tree.
 
-    for entry, fetched in fetches:
-      try:
-        data = fetched.json_content
-        base64_content = data['content']
-        decoded_content = base64.b64decode(base64_content)
-        tree.SetFile(entry['path'], decoded_content)
-      except urlfetch_errors.Error:
-        exc_info = sys.exc_info()
-        formatted_exception = traceback.format_exception(exc_info[0],
-                                                         exc_info[1],
-                                                         exc_info[2])
-        shared.w('skipping {0} {1}'.format(entry['path'], entry['url']))
-        for line in [line for line in formatted_exception if line]:
-          shared.w(line)
+    Files are written in batches as they arrive. Those fetched before a
+    failure, such as a RateLimitError, are still written.
+
+    Args:
+      tree: The Tree to write to.
+      info: The Info for the repo.
+      entries: JSON parsed blob entries of a tree listing.
+      written: A set to which written file paths are added, or None.
+
+    Returns:
+      The set of written file paths, which excludes failed fetches.
+    """
+    if written is None:
+      written = set()
+    scheduler = fetcher.FetchScheduler('{}/{}'.format(info.owner, info.repo))
+    pool = FetchManyAsyncWithAuth([entry['url'] for entry in entries],
+                                  scheduler=scheduler)
+    fetches = zip(entries, pool)
+
+    files = {}
+    batch_bytes = 0
+    try:
+      for entry, fetched in fetches:
+        try:
+          data = fetched.json_content
+          base64_content = data['content']
+          files[entry['path']] = base64.b64decode(base64_content)
+          batch_bytes += len(files[entry['path']])
+        except urlfetch_errors.Error:
+          exc_info = sys.exc_info()
+          formatted_exception = traceback.format_exception(exc_info[0],
+                                                           exc_info[1],
+                                                           exc_info[2])
+          shared.w('skipping {0} {1}'.format(entry['path'], entry['url']))
+          for line in [line for line in formatted_exception if line]:
+            shared.w(line)
+        if batch_bytes >= settings.GITHUB_WRITE_BATCH_BYTES:
+          _WriteFiles(tree, files, written)
+          files = {}
+          batch_bytes = 0
+    finally:
+      pool.Flush()
+      _WriteFiles(tree, files, written)
+    return written
@@ -0,0 +1,71 @@
+"""Tests for github.py."""
+
+import cStringIO
+import tarfile
+import unittest
+
+from . import github
+
+
+def _Tarball(members):
+  """Build a gzipped tar archive from (name, contents) tuples.
+
+  Members with None contents are added as directories.
+  """
+  buf = cStringIO.StringIO()
+  archive = tarfile.open(fileobj=buf, mode='w:gz')
+  for name, contents in members:
+    info = tarfile.TarInfo(name)
+    if contents is None:
+      info.type = tarfile.DIRTYPE
+      archive.addfile(info)
+    else:
+      info.size = len(contents)
+      archive.addfile(info, cStringIO.StringIO(contents))
+  archive.close()
+  return buf.getvalue()
+
+
+class ExtractTarballTest(unittest.TestCase):
+
+  def testExtract(self):
+    content = _Tarball([
+        ('owner-repo-abc123/', None),
+        ('owner-repo-abc123/app.yaml', 'runtime: python27\n'),
+        ('owner-repo-abc123/static/', None),
+        ('owner-repo-abc123/static/empty.txt', ''),
+        ('owner-repo-abc123/main.py', 'print 1\n'),
+    ])
+    self.assertEqual([
+        (u'app.yaml', 'runtime: python27\n'),
+        (u'static/empty.txt', ''),
+        (u'main.py', 'print 1\n'),
+    ], list(github._ExtractTarball(content)))
+
+  def testSkipExtensions(self):
+    content = _Tarball([
+        ('owner-repo-abc123/main.py', 'print 1\n'),
+        ('owner-repo-abc123/main.pyc', 'compiled'),
+        ('owner-repo-abc123/.main.py.swp', 'swap'),
+    ])
+    self.assertEqual([(u'main.py', 'print 1\n')],
+                     list(github._ExtractTarball(content)))
+
+  def testUnicodePath(self):
+    content = _Tarball([('owner-repo-abc123/caf\xc3\xa9.txt', 'contents')])
+    paths = [path for path, _ in github._ExtractTarball(content)]
+    self.assertEqual([u'caf\xe9.txt'], paths)
+    self.assertIsInstance(paths[0], unicode)
+
+  def testFilesOutsideTopLevelDirectory(self):
+    content = _Tarball([('pax_global_header', 'comment'),
+                        ('owner-repo-abc123/app.yaml', 'app')])
+    self.assertEqual([(u'app.yaml', 'app')],
+                     list(github._ExtractTarball(content)))
+
+  def testIsLazy(self):
+    content = _Tarball([('owner-repo-abc123/a', 'a'),
+                        ('owner-repo-abc123/b', 'b')])
+    files = github._ExtractTarball(content)
+    self.assertEqual((u'a', 'a'), next(files))
+    files.close()
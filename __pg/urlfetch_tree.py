@@ -15,6 +15,7 @@
 """A mutable tree implementation that is backed by URL Fetch."""
 
 
+import base64
 import datetime
 import httplib
 import json
@@ -23,10 +24,41 @@ import urllib
 from mimic.__mimic import common
 
 from error import Abort
+from . import lru
 from . import settings
 from . import shared
 
 
+# URL Fetch deadline for batch file requests
+_BATCH_DEADLINE = 30
+
+# instance-wide cache of (ETag, paths) listings, keyed by
+# (namespace, prefix, depth)
+_listing_cache = lru.LruCache(settings.URLFETCH_LISTING_CACHE_SIZE)
+
+
+def _Batches(items, sizeof, max_size, max_count):
+  """Split items into batches bounded by total size and item count."""
+  batch = []
+  batch_size = 0
+  for item in items:
+    size = sizeof(item)
+    if batch and (batch_size + size > max_size or len(batch) >= max_count):
+      yield batch
+      batch = []
+      batch_size = 0
+    batch.append(item)
+    batch_size += size
+  if batch:
+    yield batch
+
+
+def _EncodePath(path):
+  if isinstance(path, unicode):
+    return path.encode('utf-8')
+  return path
+
+
 class UrlFetchTree(common.Tree):
   """An implementation of Tree backed by URL Fetch."""
 
@@ -38,6 +70,8 @@ class UrlFetchTree(common.Tree):
     super(UrlFetchTree, self).__init__(namespace, access_key)
     self.namespace = namespace
     self.access_key = access_key
+    # listings retrieved since the last write through this tree
+    self._listings = {}
 
   def __repr__(self):
     return ('<{0} namespace={1!r}>'
@@ -56,17 +90,18 @@ class UrlFetchTree(common.Tree):
   def IsMutable(self):
     return True
 
-  def RemoteGetFile(self, path):
+  def RemoteGetFile(self, path, headers=None):
     """Retrieve the file via URL Fetch.
 
     Args:
       path: The file path.
+      headers: Additional request headers, e.g. for conditional requests.
 
     Returns:
       The URL Fetch response.
     """
     url = self._ToFileURL('file', {'path': path})
-    return shared.Fetch(self.access_key, url, method='GET')
+    return shared.Fetch(self.access_key, url, method='GET', headers=headers)
 
   def RemotePutFile(self, path, content):
     """Put the file via URL Fetch.
@@ -78,6 +113,7 @@ class UrlFetchTree(common.Tree):
     Returns:
       The URL Fetch response.
     """
+    self._listings.clear()
     url = self._ToFileURL('file', {'path': path})
     resp = shared.Fetch(self.access_key, url, method='PUT', payload=content)
     if resp.status_code != httplib.OK:
@@ -85,6 +121,92 @@ class UrlFetchTree(common.Tree):
                .format(resp.status_code, url))
     return resp
 
+  def RemoteGetFiles(self, paths):
+    """Retrieve many files via URL Fetch, in as few requests as possible.
+
+    Args:
+      paths: The file paths.
+
+    Returns:
+      A dict mapping each existing path to its contents.
+    """
+    files = {}
+    query_params = [('path', _EncodePath(p)) for p in paths]
+    sizeof = lambda param: len(urllib.urlencode([param])) + 1
+    for batch in _Batches(query_params, sizeof,
+                          settings.URLFETCH_BATCH_QUERY_LENGTH,
+                          settings.URLFETCH_BATCH_FILES):
+      url = '{}&{}'.format(self._ToFileURL('files', {}),
+                           urllib.urlencode(batch))
+      resp = shared.Fetch(self.access_key, url, method='GET',
+                          deadline=_BATCH_DEADLINE)
+      if resp.status_code != httplib.OK:
+        shared.e('{0} status code during HTTP GET on {1}'
+                 .format(resp.status_code, url))
+      for path, contents in json.loads(resp.content)['files'].iteritems():
+        files[path] = base64.b64decode(contents)
+    return files
+
+  def RemoteStat(self, paths):
+    """Retrieve file metadata via URL Fetch, without any file contents.
+
+    Args:
+      paths: A list of file paths or None for the entire tree.
+
+    Returns:
+      A dict mapping each existing path to a dict with 'size', 'mtime' (an
+      RFC 1123 date string) and 'hash' (the SHA-1 hex digest of the contents).
+    """
+    url = self._ToFileURL('stat', {})
+    if paths is not None:
+      url = '{}&{}'.format(url, urllib.urlencode([('path', _EncodePath(p))
+                                                   for p in paths]))
+    resp = shared.Fetch(self.access_key, url, method='GET')
+    if resp.status_code != httplib.OK:
+      shared.e('{0} status code during HTTP GET on {1}'
+               .format(resp.status_code, url))
+    return json.loads(resp.content)['files']
+
+  def RemoteGetManifest(self, etag=None):
+    """Retrieve the metadata of every file in the tree via URL Fetch.
+
+    Args:
+      etag: The ETag of a previously retrieved manifest, or None.
+
+    Returns:
+      None if the manifest still matches etag, otherwise an (etag, stats)
+      tuple, where stats is as returned by RemoteStat().
+    """
+    url = self._ToFileURL('stat', {})
+    headers = {'If-None-Match': etag} if etag else None
+    resp = shared.Fetch(self.access_key, url, method='GET', headers=headers,
+                        deadline=_BATCH_DEADLINE)
+    if resp.status_code == httplib.NOT_MODIFIED and etag:
+      return None
+    if resp.status_code != httplib.OK:
+      shared.e('{0} status code during HTTP GET on {1}'
+               .format(resp.status_code, url))
+    return resp.headers.get('ETag'), json.loads(resp.content)['files']
+
+  def RemotePutFiles(self, files):
+    """Put many files via URL Fetch, in as few requests as possible.
+
+    Args:
+      files: A list of (path, contents) tuples.
+    """
+    self._listings.clear()
+    url = self._ToFileURL('files', {})
+    sizeof = lambda (path, contents): len(path) + len(contents) * 4 / 3
+    for batch in _Batches(files, sizeof, settings.URLFETCH_BATCH_BYTES,
+                          settings.URLFETCH_BATCH_FILES):
+      payload = json.dumps(dict((path, base64.b64encode(contents))
+                                for path, contents in batch))
+      resp = shared.Fetch(self.access_key, url, method='PUT', payload=payload,
+                          deadline=_BATCH_DEADLINE)
+      if resp.status_code != httplib.OK:
+        shared.e('{0} status code during HTTP PUT on {1}'
+                 .format(resp.status_code, url))
+
   def GetFileContents(self, path):
     resp = self.RemoteGetFile(path)
     if resp.status_code != httplib.OK:
@@ -92,27 +214,23 @@ class UrlFetchTree(common.Tree):
     return resp.content
 
   def GetFileSize(self, path):
-    contents = self.GetFileContents(path)
-    if contents is None:
+    stat = self.RemoteStat([path]).get(path)
+    if not stat:
       return None
-    return len(contents)
+    return stat['size']
 
   def GetFileLastModified(self, path):
-    resp = self.RemoteGetFile(path)
-    if resp.status_code != httplib.OK:
+    stat = self.RemoteStat([path]).get(path)
+    if not stat or not stat['mtime']:
       return None
-    date_header = resp.headers['Last-Modified']
-    date = datetime.datetime.strptime(date_header, common.RFC_1123_DATE_FORMAT)
-    return date
+    return datetime.datetime.strptime(stat['mtime'],
+                                      common.RFC_1123_DATE_FORMAT)
 
   def HasFile(self, path):
     # root always exists, even if there are no files in the tree
     if path == '':  # pylint: disable-msg=C6403
       return True
-    resp = self.RemoteGetFile(path)
-    if resp.status_code == httplib.OK:
-      return True
-    return False
+    return path in self.RemoteStat([path])
 
   def MoveFile(self, path, newpath):
     """Rename a file.
@@ -124,6 +242,7 @@ class UrlFetchTree(common.Tree):
     Returns:
       True if the move succeeded.
     """
+    self._listings.clear()
     url = self._ToFileURL('file', {'path': path, 'newpath': newpath})
     resp = shared.Fetch(self.access_key, url, method='POST')
     if resp.status_code != httplib.OK:
@@ -140,6 +259,7 @@ class UrlFetchTree(common.Tree):
     Returns:
       True if the delete succeeded.
     """
+    self._listings.clear()
     url = self._ToFileURL('delete', {'path': path})
     resp = shared.Fetch(self.access_key, url, method='POST')
     if resp.status_code != httplib.OK:
@@ -154,9 +274,73 @@ class UrlFetchTree(common.Tree):
     resp = self.RemotePutFile(path, contents)
     assert resp.status_code == httplib.OK
 
+  def GetFiles(self, path):
+    """Retrieve all files in a directory or the tree.
+
+    Args:
+      path: The directory path or None for the entire tree.
+
+    Returns:
+      A list of (path, contents) tuples, to be passed to PutFiles().
+    """
+    prefix = self._NormalizeDirectoryPath(path) or ''
+    paths = [p for p in self.ListDirectory(None)
+             if p.startswith(prefix) and not p.endswith('/')]
+    files = self.RemoteGetFiles(paths)
+    return sorted(files.iteritems())
+
+  def PutFiles(self, files):
+    """Write files obtained from GetFiles() on any UrlFetchTree.
+
+    Args:
+      files: A list of (path, contents) tuples.
+    """
+    self.RemotePutFiles(files)
+
   def HasDirectory(self, path):
     return bool(self.ListDirectory(path))
 
+  def RemoteListDirectory(self, prefix, depth):
+    """Retrieve a directory listing via URL Fetch.
+
+    Listings are reused until the next write through this tree. Listings
+    cached by earlier trees are revalidated with their ETag, so unchanged
+    listings are not downloaded again.
+
+    Args:
+      prefix: Only list paths starting with this prefix, or None.
+      depth: Collapse paths more than depth levels below the prefix into
+          directory entries ending with '/', or None.
+
+    Returns:
+      A list of paths.
+    """
+    key = (prefix, depth)
+    paths = self._listings.get(key)
+    if paths is not None:
+      return paths
+    params = {}
+    if prefix:
+      params['prefix'] = _EncodePath(prefix)
+    if depth:
+      params['depth'] = depth
+    url = self._ToFileURL('dir', params)
+    cache_key = (self.namespace, prefix, depth)
+    cached = _listing_cache.Get(cache_key)
+    headers = {'If-None-Match': cached[0]} if cached else None
+    resp = shared.Fetch(self.access_key, url, method='GET', headers=headers)
+    if resp.status_code == httplib.NOT_MODIFIED and cached:
+      paths = cached[1]
+    else:
+      if resp.status_code != httplib.OK:
+        shared.e('{0} status code during HTTP GET on {1}'
+                 .format(resp.status_code, url))
+      paths = [f['path'] for f in json.loads(resp.content)]
+      if 'ETag' in resp.headers:
+        _listing_cache.Put(cache_key, (resp.headers['ETag'], paths))
+    self._listings[key] = paths
+    return paths
+
   def ListDirectory(self, path):
     """List the current directory or tree contents.
 
@@ -167,21 +351,11 @@ class UrlFetchTree(common.Tree):
       A list of files in the specified directory or tree.
     """
     path = self._NormalizeDirectoryPath(path)
-    url = self._ToFileURL('dir', {})
-    resp = shared.Fetch(self.access_key, url, method='GET')
-    if resp.status_code != httplib.OK:
-      shared.e('{0} status code during HTTP GET on {1}'
-               .format(resp.status_code, url))
-    files = json.loads(resp.content)
+    # 'path is None' means get all files recursively
+    if path is None:
+      return sorted(set(self.RemoteListDirectory(None, None)))
     paths = set()
-    for f in files:
-      candidate_path = f['path']
-      # 'path is None' means get all files recursively
-      if path is None:
-        paths.add(candidate_path)
-        continue
-      if not candidate_path.startswith(path):
-        continue
+    for candidate_path in self.RemoteListDirectory(path, 1):
       tail = candidate_path[len(path):]
       # return tail if tail is a file otherwise return dir name (=first segment)
       subpath = tail.split('/', 1)[0]
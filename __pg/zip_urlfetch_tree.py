@@ -15,8 +15,11 @@
 """An inmutable tree implementation that is backed by ZIP download."""
 
 
+import bisect
+import copy
 import cStringIO
 import datetime
+import hashlib
 import httplib
 import json
 import urllib
@@ -25,14 +28,150 @@ import zipfile
 from mimic.__mimic import common
 
 from error import Abort
+from . import lru
 from . import settings
 from . import shared
+from . import urlfetch_tree
 
 from google.appengine.api import urlfetch
 
 
+def _ParseDate(date):
+  return datetime.datetime.strptime(date, common.RFC_1123_DATE_FORMAT)
+
+
+class _Archive(object):
+  """A parsed ZIP archive with a path index built once per archive.
+
+  File lookups use a hash set. Directory queries bisect a sorted list of
+  paths, so every lookup is O(1) or O(log n) plus the size of the result.
+
+  Archives are immutable. Incremental changes are applied by Apply(), which
+  returns a new archive with an overlay of changed files on top of the same
+  ZIP file. Members are read directly from the downloaded bytes, which
+  cStringIO wraps without copying.
+  """
+
+  def __init__(self, content):
+    self.zip_size = len(content)
+    self.zipfile = zipfile.ZipFile(cStringIO.StringIO(content))
+    # path -> (contents, last_modified) of files changed since the download
+    self.overlay = {}
+    self.overlay_size = 0
+    # bytes held by the archive
+    self.size = self.zip_size
+    # ETag of the remote manifest this archive is known to match
+    self.manifest_etag = None
+    self._manifest = None
+    self._Index(self.zipfile.namelist())
+
+  def _Index(self, names):
+    self.files = frozenset(names)
+    self.paths = sorted(names)
+
+  def IterPrefix(self, prefix):
+    """Iterate over the sorted paths which start with prefix."""
+    for i in xrange(bisect.bisect_left(self.paths, prefix), len(self.paths)):
+      path = self.paths[i]
+      if not path.startswith(prefix):
+        break
+      yield path
+
+  def GetFileContents(self, path):
+    if path in self.overlay:
+      return self.overlay[path][0]
+    with self.zipfile.open(path) as f:
+      return f.read()
+
+  def GetFileSize(self, path):
+    if path in self.overlay:
+      return len(self.overlay[path][0])
+    return self.zipfile.getinfo(path).file_size
+
+  def GetFileLastModified(self, path):
+    if path in self.overlay:
+      return self.overlay[path][1]
+    return datetime.datetime(*self.zipfile.getinfo(path).date_time)
+
+  def GetManifest(self):
+    """Returns a dict mapping each file path to its SHA-1 content hash."""
+    if self._manifest is None:
+      self._manifest = dict(
+          (path, hashlib.sha1(self.GetFileContents(path)).hexdigest())
+          for path in self.files if not path.endswith('/'))
+    return self._manifest
+
+  def Apply(self, files, removed, stats, manifest_etag):
+    """Create a new archive with added, changed and removed files applied.
+
+    Args:
+      files: A dict mapping added or changed paths to their contents.
+      removed: A collection of removed paths.
+      stats: The remote manifest, as returned by UrlFetchTree.RemoteStat().
+      manifest_etag: The ETag of the remote manifest.
+
+    Returns:
+      The new archive.
+    """
+    archive = copy.copy(self)
+    archive.overlay = dict((path, entry)
+                           for path, entry in self.overlay.iteritems()
+                           if path not in removed)
+    for path, contents in files.iteritems():
+      mtime = stats[path]['mtime']
+      archive.overlay[path] = (contents, mtime and _ParseDate(mtime))
+    archive.overlay_size = sum(len(entry[0])
+                               for entry in archive.overlay.itervalues())
+    archive.size = self.zip_size + archive.overlay_size
+    archive.manifest_etag = manifest_etag
+    archive._manifest = dict((path, stat['hash'])
+                             for path, stat in stats.iteritems())
+    archive._Index((self.files - frozenset(removed)) | frozenset(files))
+    return archive
+
+
+# instance-wide cache of parsed project archives, keyed by namespace
+_archive_cache = lru.LruCache(settings.ZIP_ARCHIVE_CACHE_BYTES,
+                              sizeof=lambda archive: archive.size)
+
+
+def _SyncArchive(archive, remote):
+  """Bring a cached archive up to date with the remote tree.
+
+  Args:
+    archive: The cached archive.
+    remote: An UrlFetchTree for the same project.
+
+  Returns:
+    An up to date archive, or None if the changes, together with those
+    already applied to the archive, are too large to transfer incrementally.
+  """
+  manifest = remote.RemoteGetManifest(archive.manifest_etag)
+  if manifest is None:
+    return archive
+  manifest_etag, stats = manifest
+  local = archive.GetManifest()
+  changed = [path for path, stat in stats.iteritems()
+             if local.get(path) != stat['hash']]
+  removed = [path for path in local if path not in stats]
+  # the overlay grows with every sync until the next full download
+  changed_size = sum(stats[path]['size'] for path in changed)
+  if archive.overlay_size + changed_size > settings.ZIP_SYNC_MAX_BYTES:
+    return None
+  shared.i('syncing {} changed and {} removed files in {}'
+           .format(len(changed), len(removed), remote.namespace))
+  files = remote.RemoteGetFiles(changed) if changed else {}
+  return archive.Apply(files, removed, stats, manifest_etag)
+
+
 class ZipUrlFetchTree(common.Tree):
-  """An implementation of Tree backed by ZIP download via URL Fetch."""
+  """An implementation of Tree backed by ZIP download via URL Fetch.
+
+  Parsed archives are cached per instance. Later trees for the same project
+  compare the cached archive against the remote file manifest and fetch only
+  added or changed files, so the full archive is downloaded again only when
+  the changes are large.
+  """
 
   def __init__(self, namespace, access_key):
     if not namespace:
@@ -43,16 +182,30 @@ class ZipUrlFetchTree(common.Tree):
     self.namespace = namespace
     self.access_key = access_key
 
+    cached = _archive_cache.Get(namespace)
+    archive = None
+    if cached:
+      remote = urlfetch_tree.UrlFetchTree(namespace, access_key)
+      archive = _SyncArchive(cached, remote)
+    if not archive:
+      archive = self._DownloadArchive()
+    if archive.size > settings.ZIP_ARCHIVE_CACHE_MAX_ENTRY_BYTES:
+      _archive_cache.Pop(namespace)
+    elif archive is not cached:
+      _archive_cache.Put(namespace, archive)
+    self._archive = archive
+
+  def _DownloadArchive(self):
     path_info = '{}/zip'.format(common.CONTROL_PREFIX)
     query_params = '{}={}&use_basepath=false'.format(
-      common.config.PROJECT_ID_QUERY_PARAM, namespace)
+      common.config.PROJECT_ID_QUERY_PARAM, self.namespace)
     playground_hostname = (settings.PLAYGROUND_USER_CONTENT_HOST or
                            settings.PLAYGROUND_HOSTS[0])
     url = 'https://{}{}?{}'.format(playground_hostname, path_info, query_params)
 
-    result = shared.Fetch(access_key, url, method='GET', deadline=30, retries=3)
-    buf = cStringIO.StringIO(result.content)
-    self._zipfile = zipfile.ZipFile(buf)
+    result = shared.Fetch(self.access_key, url, method='GET', deadline=30,
+                          retries=3)
+    return _Archive(result.content)
 
   def __repr__(self):
     return ('<{0} namespace={1!r}>'
@@ -62,34 +215,30 @@ class ZipUrlFetchTree(common.Tree):
     return False
 
   def GetFileContents(self, path):
-    if path not in self._zipfile.namelist():
+    if path not in self._archive.files:
       return None
-    with self._zipfile.open(path) as f:
-      return f.read()
+    return self._archive.GetFileContents(path)
 
   def GetFileSize(self, path):
-    if path not in self._zipfile.namelist():
+    if path not in self._archive.files:
       return 0
-    return self._zipfile.getinfo(path).file_size
+    return self._archive.GetFileSize(path)
 
   def GetFileLastModified(self, path):
-    dt = self._zipfile.getinfo(path).date_time
-    return datetime.datetime(*dt)
+    return self._archive.GetFileLastModified(path)
 
   def HasFile(self, path):
     # root always exists, even if there are no files in the tree
     if path == '':  # pylint: disable-msg=C6403
       return True
-    return path in self._zipfile.namelist()
+    return path in self._archive.files
 
   def HasDirectory(self, path):
-    path = self._NormalizeDirectoryPath(path)
-    for p in self._zipfile.namelist():
-      if p.startswith(path):
-        return True
+    path = self._NormalizeDirectoryPath(path) or ''
+    for _ in self._archive.IterPrefix(path):
+      return True
     return False
 
   def ListDirectory(self, path):
-    path = self._NormalizeDirectoryPath(path)
-    paths = [p for p in self._zipfile.namelist() if p.startswith(path)]
-    return sorted(paths)
+    path = self._NormalizeDirectoryPath(path) or ''
+    return list(self._archive.IterPrefix(path))
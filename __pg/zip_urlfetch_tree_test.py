@@ -0,0 +1,69 @@
+"""Tests for zip_urlfetch_tree.py."""
+
+import cStringIO
+import unittest
+import zipfile
+
+from . import zip_urlfetch_tree
+
+
+def _Archive(paths):
+  buf = cStringIO.StringIO()
+  z = zipfile.ZipFile(buf, 'w')
+  for path in paths:
+    z.writestr(path, 'contents of {}'.format(path))
+  z.close()
+  return zip_urlfetch_tree._Archive(buf.getvalue())
+
+
+class ArchiveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.archive = _Archive(['static/js/app.js', 'app.yaml', 'static/a.css',
+                             'staticfile.txt', 'main.py'])
+
+  def testIterPrefix(self):
+    self.assertEqual(['static/a.css', 'static/js/app.js'],
+                     list(self.archive.IterPrefix('static/')))
+    self.assertEqual(['static/js/app.js'],
+                     list(self.archive.IterPrefix('static/js/')))
+
+  def testIterPrefixAll(self):
+    self.assertEqual(['app.yaml', 'main.py', 'static/a.css',
+                      'static/js/app.js', 'staticfile.txt'],
+                     list(self.archive.IterPrefix('')))
+
+  def testIterPrefixNoMatch(self):
+    self.assertEqual([], list(self.archive.IterPrefix('lib/')))
+    self.assertEqual([], list(self.archive.IterPrefix('zzz')))
+
+  def testIterPrefixAfterApply(self):
+    stats = {
+        'app.yaml': {'hash': '', 'mtime': None},
+        'main.py': {'hash': '', 'mtime': None},
+        'static/b.css': {'hash': '', 'mtime': None},
+        'static/js/app.js': {'hash': '', 'mtime': None},
+        'staticfile.txt': {'hash': '', 'mtime': None},
+    }
+    archive = self.archive.Apply({'static/b.css': 'b'}, ['static/a.css'],
+                                 stats, '"etag"')
+    self.assertEqual(['static/b.css', 'static/js/app.js'],
+                     list(archive.IterPrefix('static/')))
+    self.assertEqual('b', archive.GetFileContents('static/b.css'))
+    # the original archive is unchanged
+    self.assertEqual(['static/a.css', 'static/js/app.js'],
+                     list(self.archive.IterPrefix('static/')))
+
+  def testApplySize(self):
+    stats = {'main.py': {'hash': '', 'mtime': None},
+             'app.yaml': {'hash': '', 'mtime': None}}
+    archive = self.archive.Apply({'main.py': 'x' * 10}, [], stats, None)
+    self.assertEqual(10, archive.overlay_size)
+    self.assertEqual(self.archive.zip_size + 10, archive.size)
+    # replaced and removed overlay files no longer count
+    archive = archive.Apply({'main.py': 'x' * 4, 'app.yaml': 'y'}, [], stats,
+                            None)
+    self.assertEqual(5, archive.overlay_size)
+    archive = archive.Apply({}, ['main.py'], stats, None)
+    self.assertEqual(1, archive.overlay_size)
+    self.assertEqual(self.archive.zip_size + 1, archive.size)
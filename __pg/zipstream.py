@@ -0,0 +1,87 @@
+"""Incremental ZIP archive writer for streaming downloads.
+
+Python 2.7's zipfile module requires a seekable output file, so it cannot
+produce an archive while it is being sent. This module writes entries one
+file at a time, deflated unless that does not make them smaller.
+"""
+
+import datetime
+import struct
+import zlib
+
+
+_LOCAL_FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+_CENTRAL_DIRECTORY_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_END_OF_CENTRAL_DIRECTORY = struct.Struct('<4s4H2LH')
+
+_VERSION = 20
+_ZIP_STORED = 0
+_ZIP_DEFLATED = 8
+# zlib compression level, trading CPU time for download size
+_COMPRESS_LEVEL = 6
+# general purpose flag bit 11: file name is UTF-8 encoded
+_FLAG_UTF8 = 0x800
+# -rw-r--r-- regular file, in the high word of the external attributes
+_EXTERNAL_ATTR = (0100644 & 0xFFFF) << 16
+# created on unix
+_CREATE_SYSTEM = 3
+
+
+def _EncodeName(path):
+  if isinstance(path, unicode):
+    return path.encode('utf-8'), _FLAG_UTF8
+  return path, 0
+
+
+def _DosDateTime(dt):
+  dt = max(dt or datetime.datetime.now(), datetime.datetime(1980, 1, 1))
+  dos_time = (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2)
+  dos_date = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+  return dos_time, dos_date
+
+
+def _Deflate(contents):
+  """Compress contents as a raw deflate stream, as stored in ZIP entries."""
+  compressor = zlib.compressobj(_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(contents) + compressor.flush()
+
+
+def StreamZip(files):
+  """Generate a ZIP archive incrementally.
+
+  Only one file's contents are held in memory at a time.
+
+  Args:
+    files: An iterable of (path, last_modified, contents) tuples.
+
+  Yields:
+    Consecutive chunks of the archive.
+  """
+  central_directory = []
+  offset = 0
+  for path, last_modified, contents in files:
+    name, flags = _EncodeName(path)
+    dos_time, dos_date = _DosDateTime(last_modified)
+    crc = zlib.crc32(contents) & 0xFFFFFFFF
+    size = len(contents)
+    # the whole file is in memory, so sizes are known before the header
+    data = _Deflate(contents)
+    method = _ZIP_DEFLATED
+    if len(data) >= size:
+      data = contents
+      method = _ZIP_STORED
+    header = _LOCAL_FILE_HEADER.pack('PK\003\004', _VERSION, 0, flags,
+                                     method, dos_time, dos_date, crc,
+                                     len(data), size, len(name), 0)
+    central_directory.append(_CENTRAL_DIRECTORY_HEADER.pack(
+        'PK\001\002', _VERSION, _CREATE_SYSTEM, _VERSION, 0, flags,
+        method, dos_time, dos_date, crc, len(data), size, len(name), 0, 0, 0,
+        0, _EXTERNAL_ATTR, offset) + name)
+    yield header + name
+    yield data
+    offset += len(header) + len(name) + len(data)
+  count = len(central_directory)
+  central_directory = ''.join(central_directory)
+  yield central_directory
+  yield _END_OF_CENTRAL_DIRECTORY.pack('PK\005\006', 0, 0, count, count,
+                                       len(central_directory), offset, 0)
@@ -0,0 +1,72 @@
+"""Tests for zipstream.py."""
+
+import cStringIO
+import datetime
+import unittest
+import zipfile
+
+from . import zipstream
+
+
+def _ReadZip(files):
+  archive = ''.join(zipstream.StreamZip(files))
+  return zipfile.ZipFile(cStringIO.StringIO(archive))
+
+
+class StreamZipTest(unittest.TestCase):
+
+  def testEmpty(self):
+    z = _ReadZip([])
+    self.assertEqual([], z.namelist())
+    self.assertIsNone(z.testzip())
+
+  def testFiles(self):
+    mtime = datetime.datetime(2013, 5, 17, 12, 30, 44)
+    z = _ReadZip([
+        ('app.yaml', mtime, 'runtime: python27\n'),
+        ('static/empty.txt', mtime, ''),
+        ('main.py', mtime, 'x' * 100000),
+    ])
+    self.assertIsNone(z.testzip())
+    self.assertEqual(['app.yaml', 'static/empty.txt', 'main.py'],
+                     z.namelist())
+    self.assertEqual('runtime: python27\n', z.read('app.yaml'))
+    self.assertEqual('', z.read('static/empty.txt'))
+    self.assertEqual('x' * 100000, z.read('main.py'))
+    info = z.getinfo('app.yaml')
+    self.assertEqual((2013, 5, 17, 12, 30, 44), info.date_time)
+
+  def testCompression(self):
+    z = _ReadZip([('main.py', None, 'x' * 100000),
+                  ('a.txt', None, 'a'),
+                  ('empty.txt', None, '')])
+    self.assertIsNone(z.testzip())
+    info = z.getinfo('main.py')
+    self.assertEqual(zipfile.ZIP_DEFLATED, info.compress_type)
+    self.assertLess(info.compress_size, 1000)
+    self.assertEqual(100000, info.file_size)
+    # incompressible entries are stored
+    self.assertEqual(zipfile.ZIP_STORED, z.getinfo('a.txt').compress_type)
+    self.assertEqual(zipfile.ZIP_STORED, z.getinfo('empty.txt').compress_type)
+    self.assertEqual('a', z.read('a.txt'))
+
+  def testUnicodePath(self):
+    z = _ReadZip([(u'caf\xe9.txt', None, 'contents')])
+    self.assertEqual([u'caf\xe9.txt'], z.namelist())
+    self.assertEqual('contents', z.read(u'caf\xe9.txt'))
+
+  def testDatesBeforeDosEpoch(self):
+    z = _ReadZip([('old.txt', datetime.datetime(1970, 1, 1), 'old')])
+    self.assertEqual((1980, 1, 1, 0, 0, 0), z.getinfo('old.txt').date_time)
+
+  def testStreamsOneFileAtATime(self):
+    consumed = []
+
+    def Files():
+      for name in ('a', 'b'):
+        consumed.append(name)
+        yield name, None, name
+
+    chunks = zipstream.StreamZip(Files())
+    next(chunks)
+    self.assertEqual(['a'], consumed)
@@ -1006,13 +1006,14 @@ function ProjectController($scope, $browser, $http, $routeParams, $window, $sce,
 
   $scope.download_project = function(filename, label) {
     track('download-project', label);
-    var project_id = $scope.namespace();
-    $window.location = $scope.url_of('zip', {filename: filename});
+    $window.location = '/playground/p/' + encodeURI($scope.project.key) +
+                       '/download?filename=' + encodeURIComponent(filename);
   };
 
   $scope.handle_download_button = function(project) {
     var filename = project.download_filename;
     if (!filename) {
+      // keep in sync with model.GetProjectDownloadFilename()
       filename = project.name;
       filename = filename.replace(/[^a-zA-Z0-9-]/g, '_');
       filename = filename + '.zip';
@@ -7,9 +7,9 @@ import sys
 
 
 from mimic.__mimic import common
-from mimic.__mimic import datastore_tree
 
 from __pg import appids
+from __pg import cow_tree
 from __pg import settings
 from __pg import zip_urlfetch_tree
 
@@ -32,7 +32,7 @@ app_id = app_identity.get_application_id()
 
 # pylint: disable-msg=invalid-name
 if common.IsDevMode() or app_id == appids.PLAYGROUND_APP_ID:
-  mimic_CREATE_TREE_FUNC = datastore_tree.DatastoreTree
+  mimic_CREATE_TREE_FUNC = cow_tree.CreateTree
 else:
   mimic_CREATE_TREE_FUNC = zip_urlfetch_tree.ZipUrlFetchTree
 